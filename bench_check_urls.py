@@ -0,0 +1,409 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+# CowBots -- Error detection bots for CKAN-of-Worms
+# By: Emmanuel Raviart <emmanuel@raviart.com>
+#
+# Copyright (C) 2013 Etalab
+# http://github.com/etalab/cowbots
+#
+# This file is part of CowBots.
+#
+# CowBots is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# CowBots is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Benchmark check_urls offline, against local stand-ins of web servers, FTP servers and CKAN-of-Worms."""
+
+
+import argparse
+import BaseHTTPServer
+import copy
+import json
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import SocketServer
+import sys
+import tempfile
+import threading
+import time
+import urlparse
+import uuid
+
+import check_urls
+
+
+alerts_count = 0
+args = None
+dataset_by_id = {}
+hang_duration = 3600  # seconds
+statistics_lock = threading.Lock()
+
+
+# Classes
+
+
+class CowRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # Stand-in of the CKAN-of-Worms API, serving the synthetic datasets and accepting their alerts
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        path = urlparse.urlsplit(self.path).path.strip('/').split('/')
+        if path == ['api', '1', 'datasets']:
+            self.send_cow_response(sorted(dataset_by_id))
+        elif path[:3] == ['api', '1', 'datasets'] and len(path) == 4 and path[3] in dataset_by_id:
+            self.send_cow_response(dataset_by_id[path[3]])
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        global alerts_count
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        with statistics_lock:
+            alerts_count += 1
+        self.send_cow_response(json.loads(body))
+
+    def log_message(self, format, *arguments):
+        pass
+
+    def send_cow_response(self, value):
+        body = json.dumps(dict(
+            apiVersion = '1.0',
+            method = self.command,
+            params = {},
+            url = 'http://{}:{}{}'.format(self.server.server_address[0], self.server.server_address[1], self.path),
+            value = value,
+            ))
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class FtpRequestHandler(SocketServer.StreamRequestHandler):
+    # Stand-in of an FTP server, answering only the control commands used by check_urls
+    def handle(self):
+        self.send_reply('220 Benchmark FTP server ready.')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command, _, argument = line.strip().partition(' ')
+            command = command.upper()
+            if command == 'USER':
+                self.send_reply('331 Password required.')
+            elif command == 'PASS':
+                self.send_reply('230 Logged in.')
+            elif command == 'TYPE':
+                self.send_reply('200 Type set.')
+            elif command == 'PWD':
+                self.send_reply('257 "/" is the current directory.')
+            elif command == 'CWD':
+                self.send_reply('250 OK.' if argument in ('/', 'pub') else '550 No such directory.')
+            elif command == 'SIZE':
+                kind, latency, size = parse_behaviour(argument)
+                time.sleep(latency)
+                if kind == 'hang':
+                    time.sleep(hang_duration)
+                    return
+                self.send_reply('213 {}'.format(size) if kind in ('close', 'nohead', 'ok', 'redirect')
+                    else '550 Not found.')
+            elif command == 'QUIT':
+                self.send_reply('221 Bye.')
+                return
+            else:
+                self.send_reply('502 Command not implemented.')
+
+    def send_reply(self, reply):
+        self.wfile.write(reply + '\r\n')
+
+
+class ThreadingFtpServer(SocketServer.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # check_urls closes its connections without waiting, when they time out or are no longer needed.
+        if not isinstance(sys.exc_info()[1], IOError):
+            SocketServer.ThreadingTCPServer.handle_error(self, request, client_address)
+
+
+class ThreadingHttpServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def handle_error(self, request, client_address):
+        # check_urls closes its connections as soon as it has read enough of the response.
+        if not isinstance(sys.exc_info()[1], IOError):
+            BaseHTTPServer.HTTPServer.handle_error(self, request, client_address)
+
+
+class WebRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # Stand-in of a slow & unreliable web server, whose behaviour is encoded in the path of each URL
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.respond(send_body = True)
+
+    def do_HEAD(self):
+        self.respond(send_body = False)
+
+    def log_message(self, format, *arguments):
+        pass
+
+    def respond(self, send_body):
+        kind, latency, size = parse_behaviour(self.path)
+        time.sleep(latency)
+        if kind == 'hang':
+            time.sleep(hang_duration)
+            return
+        if kind == 'error':
+            self.send_error(404 if size % 2 else 500)
+            return
+        if kind in ('close', 'nohead') and not send_body:
+            self.send_error(405)
+            return
+        if kind == 'redirect':
+            self.send_response(302)
+            self.send_header('Location', self.path.replace('/redirect/', '/ok/', 1))
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        if kind == 'close':
+            # Old-style server, delimiting the body by closing the connection.
+            self.send_header('Connection', 'close')
+            self.close_connection = 1
+        else:
+            self.send_header('Content-Length', str(size))
+        self.end_headers()
+        if send_body:
+            # Ignore the Range header, like many web servers do.
+            chunk = 'x' * 65536
+            remaining = size
+            try:
+                while remaining > 0:
+                    self.wfile.write(chunk[:remaining])
+                    remaining -= len(chunk)
+            except IOError:
+                # Client has closed the connection after reading the first bytes.
+                self.close_connection = 1
+
+
+# Functions
+
+
+def generate_datasets(http_servers, ftp_server):
+    rand = random.Random(args.seed)
+    urls = []
+    for index in range(args.urls):
+        draw = rand.random()
+        if draw < args.hang_rate:
+            kind = 'hang'
+        elif draw < args.hang_rate + args.error_rate:
+            kind = 'error'
+        elif draw < args.hang_rate + args.error_rate + args.redirect_rate:
+            kind = 'redirect'
+        elif draw < args.hang_rate + args.error_rate + args.redirect_rate + args.nohead_rate:
+            kind = 'nohead'
+        elif draw < args.hang_rate + args.error_rate + args.redirect_rate + args.nohead_rate + args.close_rate:
+            kind = 'close'
+        else:
+            kind = 'ok'
+        latency = int(rand.expovariate(1.0 / args.latency) * 1000) if args.latency > 0 else 0  # milliseconds
+        size = int(rand.expovariate(1.0 / args.body_size)) if args.body_size > 0 else 0
+        if rand.random() < args.ftp_rate:
+            host, port = ftp_server.server_address
+            urls.append(u'ftp://{}:{}/pub/{}/{}/{}/{}'.format(host, port, kind, latency, size, index))
+        else:
+            host, port = rand.choice(http_servers).server_address
+            urls.append(u'http://{}:{}/{}/{}/{}/{}'.format(host, port, kind, latency, size, index))
+    for index in range(args.datasets):
+        dataset_id = unicode(uuid.UUID(int = rand.getrandbits(128)))
+        dataset_by_id[dataset_id] = dict(
+            alerts = {},
+            draft_id = unicode(uuid.UUID(int = rand.getrandbits(128))),
+            id = dataset_id,
+            name = u'dataset-{}'.format(index),
+            related = [],
+            resources = [
+                dict(
+                    format = u'CSV',
+                    url = rand.choice(urls),
+                    )
+                for resource_index in range(args.resources)
+                ],
+            url = None,
+            )
+    return len(set(urls))
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__)
+    parser.add_argument('--body-size', default = 100000, help = 'mean size of resources, in bytes', type = int)
+    parser.add_argument('-c', '--thread-count', default = 20, help = 'number of check_urls workers', type = int)
+    parser.add_argument('--close-rate', default = 0.05,
+        help = 'ratio of URLs refusing HEAD requests and closing the connection after the body', type = float)
+    parser.add_argument('-d', '--datasets', default = 200, help = 'number of synthetic datasets', type = int)
+    parser.add_argument('-e', '--engine', choices = ['gevent', 'threads'], default = 'threads',
+        help = 'concurrency engine of check_urls')
+    parser.add_argument('--error-rate', default = 0.05, help = 'ratio of URLs answering 404 or 500', type = float)
+    parser.add_argument('--ftp-rate', default = 0.05, help = 'ratio of FTP URLs', type = float)
+    parser.add_argument('--hang-rate', default = 0.01, help = 'ratio of URLs never answering', type = float)
+    parser.add_argument('--hosts', default = 8, help = 'number of distinct web servers (127.0.0.x)', type = int)
+    parser.add_argument('-l', '--latency', default = 0.05,
+        help = 'mean number of seconds before a server answers', type = float)
+    parser.add_argument('-m', '--mode', choices = ['both', 'fedmsg', 'full'], default = 'both',
+        help = 'check_urls path to benchmark: full scan, fedmsg messages or both')
+    parser.add_argument('--nohead-rate', default = 0.05, help = 'ratio of URLs refusing HEAD requests',
+        type = float)
+    parser.add_argument('-r', '--resources', default = 10, help = 'number of resources of each dataset', type = int)
+    parser.add_argument('--redirect-rate', default = 0.1, help = 'ratio of URLs redirecting', type = float)
+    parser.add_argument('-s', '--seed', default = 0, help = 'seed of the random generation of datasets', type = int)
+    parser.add_argument('-u', '--urls', default = 1000, help = 'number of distinct URLs', type = int)
+    parser.add_argument('--url-timeout', default = 5,
+        help = 'total number of seconds allowed to check an URL', type = float)
+    parser.add_argument('-v', '--verbose', action = 'store_true', help = 'increase output verbosity')
+
+    global args
+    args = parser.parse_args()
+
+    http_servers = [
+        start_server(ThreadingHttpServer, WebRequestHandler, '127.0.0.{}'.format(index + 1))
+        for index in range(args.hosts)
+        ]
+    ftp_server = start_server(ThreadingFtpServer, FtpRequestHandler, '127.0.0.1')
+    cow_server = start_server(ThreadingHttpServer, CowRequestHandler, '127.0.0.1')
+    urls_count = generate_datasets(http_servers, ftp_server)
+    print 'Datasets: {}, distinct URLs: {}, URLs of datasets: {}'.format(len(dataset_by_id), urls_count,
+        len(dataset_by_id) * args.resources)
+
+    for mode in (['full', 'fedmsg'] if args.mode == 'both' else [args.mode]):
+        global alerts_count
+        alerts_count = 0
+        work_dir = tempfile.mkdtemp(prefix = 'bench-check-urls-')
+        try:
+            results_queue = multiprocessing.Queue()
+            # Each run uses its own process, to start with a cold cache and to measure its own peak memory.
+            process = multiprocessing.Process(target = run_check_urls,
+                args = (mode, work_dir, cow_server.server_address, results_queue))
+            process.start()
+            results = results_queue.get()
+            process.join()
+        finally:
+            shutil.rmtree(work_dir)
+        if results is None:
+            print >> sys.stderr, 'check_urls has failed in mode {}.'.format(mode)
+            return 1
+        durations = sorted(results['durations'])
+        print
+        print 'Mode: {}'.format(mode)
+        print '  Elapsed time: {:.2f} s'.format(results['elapsed'])
+        print '  URL checks: {} ({:.1f} checks/s)'.format(len(durations), len(durations) / results['elapsed'])
+        print '  Datasets: {:.1f} datasets/s, {} alerts posted'.format(len(dataset_by_id) / results['elapsed'],
+            alerts_count)
+        print '  Latency of URL checks: p50 {:.3f} s, p99 {:.3f} s, max {:.3f} s'.format(
+            percentile(durations, 50), percentile(durations, 99), durations[-1] if durations else 0)
+        print '  Peak RSS: {:.1f} MiB'.format(results['max_rss'] / 1024.0)
+        print '  Bytes downloaded: {}'.format(results['bytes'])
+    return 0
+
+
+def parse_behaviour(path):
+    # Path ends with kind/latency (ms)/size/index.
+    kind, latency, size = urlparse.urlsplit(path).path.strip('/').split('/')[-4:-1]
+    return kind, int(latency) / 1000.0, int(size)
+
+
+def percentile(values, rank):
+    # Nearest-rank percentile of sorted values
+    if not values:
+        return 0
+    return values[min(len(values) - 1, max(0, int(round(rank / 100.0 * len(values))) - 1))]
+
+
+def run_check_urls(mode, work_dir, cow_address, results_queue):
+    config_path = os.path.join(work_dir, 'bench.ini')
+    with open(config_path, 'w') as config_file:
+        config_file.write('\n'.join([
+            '[CowBots-Check-URLs]',
+            'cache_path = {}'.format(os.path.join(work_dir, 'cache.sqlite')),
+            'ckan_of_worms.api_key = bench',
+            'ckan_of_worms.site_url = http://{}:{}/'.format(*cow_address),
+            'user_agent = bench-check-urls',
+            '',
+            ]))
+
+    # Measure every URL check and every byte received by check_urls.
+    durations = []
+    statistics = dict(bytes = 0)
+    original_check_url = check_urls.check_url
+    original_recv = check_urls.DeadlineSocket.recv
+
+    def check_url(url, state, previous_url_check = None):
+        start_time = time.time()
+        try:
+            return original_check_url(url, state, previous_url_check = previous_url_check)
+        finally:
+            durations.append(time.time() - start_time)
+
+    def recv(self, *arguments):
+        data = original_recv(self, *arguments)
+        with statistics_lock:
+            statistics['bytes'] += len(data)
+        return data
+
+    def poll_fedmsg(config_parser):
+        # Replay a "dataset update" message for every dataset.
+        for dataset in dataset_by_id.itervalues():
+            check_urls.enqueue_task(check_urls.check_dataset_urls, copy.deepcopy(dataset))
+
+    check_urls.check_url = check_url
+    check_urls.DeadlineSocket.recv = recv
+    check_urls.poll_fedmsg = poll_fedmsg
+
+    sys.argv = [check_urls.__file__, config_path, '--engine', args.engine, '--thread-count', str(args.thread_count),
+        '--url-timeout', str(args.url_timeout)]
+    if mode == 'fedmsg':
+        sys.argv.append('--fedmsg')
+    if args.verbose:
+        sys.argv.append('--verbose')
+    start_time = time.time()
+    try:
+        check_urls.main()
+    except:
+        results_queue.put(None)
+        raise
+    results_queue.put(dict(
+        bytes = statistics['bytes'],
+        durations = durations,
+        elapsed = time.time() - start_time,
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,  # KiB on Linux
+        ))
+
+
+def start_server(server_class, request_handler_class, host):
+    server = server_class((host, 0), request_handler_class)
+    thread = threading.Thread(target = server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -29,11 +29,18 @@
 
 import argparse
 import ConfigParser
+import hashlib
+import inspect
 import json
 import logging
+import multiprocessing
 import os
+import Queue
 import re
+import sqlite3
 import sys
+import threading
+import traceback
 import urllib2
 import urlparse
 
@@ -71,13 +78,24 @@ from biryani1.jsonconv import (
     )
 from biryani1.states import default_state
 
+import memoconv
+from memoconv import memoize
 
+
+app_dir = os.path.dirname(os.path.abspath(__file__))
 app_name = os.path.splitext(os.path.basename(__file__))[0]
+args = None
+cache_db = None
+cache_lock = threading.Lock()
 conf = None
 headers = None
 log = logging.getLogger(app_name)
+messages_queues = []  # Queue of each worker, in fedmsg mode
+messages_lock = threading.Lock()
 N_ = lambda message: message
 name_re = re.compile(ur'[-_\da-z]+$')
+sequence_by_dataset_id = {}  # Sequence number of the latest queued message of each dataset, in fedmsg mode
+rules_version = None  # Hash of the converters, to invalidate the cached alerts when they change
 slug_re = re.compile(ur'[-\da-z]+$')
 uuid_re = re.compile(ur'[\da-f]{8}-[\da-f]{4}-[\da-f]{4}-[\da-f]{4}-[\da-f]{12}$')
 year_or_month_or_day_re = re.compile(ur'[0-2]\d{3}(-(0[1-9]|1[0-2])(-([0-2]\d|3[0-1]))?)?$')
@@ -116,20 +134,26 @@ cow_json_to_name = pipe(
     test(lambda name: len(name) <= 100, error = N_(u'String is too long')),
     )
 
-cow_json_to_slug = pipe(
-    test_isinstance(basestring),
-    test(lambda slug: slug == strings.slugify(slug), error = N_(u'String is not a slug')),
+cow_json_to_slug = memoize(
+    pipe(
+        test_isinstance(basestring),
+        test(lambda slug: slug == strings.slugify(slug), error = N_(u'String is not a slug')),
+        ),
+    'cow_json_to_slug',
     )
 
-cow_json_to_tag_name = pipe(
-    test_isinstance(basestring),
-    test(lambda name: name == name.strip(), error = N_(u'String begins or ends with spaces')),
-    test(lambda name: name == name.strip('-'), error = N_(u'String begins or ends with "-"')),
-    test(lambda name: '--' not in name, error = N_(u'String contains duplicate "-"')),
-    test(lambda name: name.islower(), error = N_(u'String must contain only lowercase characters')),
-    test(name_re.match, error = N_(u'String must contain only "a"-"z", "0"-"9" & "-"')),
-    test(lambda name: len(name) >= 2, error = N_(u'String is too short')),
-    test(lambda name: len(name) <= 100, error = N_(u'String is too long')),
+cow_json_to_tag_name = memoize(
+    pipe(
+        test_isinstance(basestring),
+        test(lambda name: name == name.strip(), error = N_(u'String begins or ends with spaces')),
+        test(lambda name: name == name.strip('-'), error = N_(u'String begins or ends with "-"')),
+        test(lambda name: '--' not in name, error = N_(u'String contains duplicate "-"')),
+        test(lambda name: name.islower(), error = N_(u'String must contain only lowercase characters')),
+        test(name_re.match, error = N_(u'String must contain only "a"-"z", "0"-"9" & "-"')),
+        test(lambda name: len(name) >= 2, error = N_(u'String is too short')),
+        test(lambda name: len(name) <= 100, error = N_(u'String is too long')),
+        ),
+    'cow_json_to_tag_name',
     )
 
 cow_json_to_title = pipe(
@@ -489,56 +513,60 @@ cow_json_to_warning_verified_dataset = pipe(
                                     cow_json_to_markdown,
                                     # not_none,  Currently we accept that only a title be given.
                                     ),
-                                format = pipe(
-                                    test_isinstance(basestring),
-                                    test_conv(
-                                        pipe(
-                                            function(lambda format: format.upper()),
-                                            test_not_in(['KMLZ'], error = N_(u'Invalid format; use "KML" instead')),
-                                            test_not_in(['SVGZ'], error = N_(u'Invalid format; use "SVG" instead')),
-                                            test_not_in(['XLSX'], error = N_(u'Invalid format; use "XLS" instead')),
-                                            test_in([
-                                                u'CSV',
-                                                u'DOC',
-                                                u'DXF',
-                                                u'GEOJSON',
-                                                u'GML',
-                                                u'GPX',
-                                                u'GTFS',
-                                                u'GZ',
-                                                u'HTML',
-                                                u'JPG',
-                                                u'JSON',
-                                                u'KML',
-                                                u'MID',
-                                                u'MIF',
-                                                u'ODS',
-                                                u'ODT',
-                                                u'PDF',
-                                                u'PNG',
-                                                u'PPT',
-                                                u'RDF',
-                                                u'RSS',
-                                                u'RTF',
-                                                u'SVG',
-                                                u'SHP',
-                                                u'SQL',
-                                                u'TIFF',
-                                                u'TXT',
-                                                u'WMS',
-                                                u'XLS',
-                                                u'XML',
-                                                u'XSD',
-                                                u'WFS',
-                                                u'WMS',
-                                                u'ZIP',
-                                                ]),
+                                format = memoize(
+                                    pipe(
+                                        test_isinstance(basestring),
+                                        test_conv(
+                                            pipe(
+                                                function(lambda format: format.upper()),
+                                                test_not_in(['KMLZ'], error = N_(u'Invalid format; use "KML" instead')),
+                                                test_not_in(['SVGZ'], error = N_(u'Invalid format; use "SVG" instead')),
+                                                test_not_in(['XLSX'], error = N_(u'Invalid format; use "XLS" instead')),
+                                                test_in([
+                                                    u'CSV',
+                                                    u'DOC',
+                                                    u'DXF',
+                                                    u'GEOJSON',
+                                                    u'GML',
+                                                    u'GPX',
+                                                    u'GTFS',
+                                                    u'GZ',
+                                                    u'HTML',
+                                                    u'JPG',
+                                                    u'JSON',
+                                                    u'KML',
+                                                    u'MID',
+                                                    u'MIF',
+                                                    u'ODS',
+                                                    u'ODT',
+                                                    u'PDF',
+                                                    u'PNG',
+                                                    u'PPT',
+                                                    u'RDF',
+                                                    u'RSS',
+                                                    u'RTF',
+                                                    u'SVG',
+                                                    u'SHP',
+                                                    u'SQL',
+                                                    u'TIFF',
+                                                    u'TXT',
+                                                    u'WMS',
+                                                    u'XLS',
+                                                    u'XML',
+                                                    u'XSD',
+                                                    u'WFS',
+                                                    u'WMS',
+                                                    u'ZIP',
+                                                    ]),
+                                                ),
                                             ),
+                                        # Don't test capitalization, because CKAN uses sometimes upper and lower
+                                        # characters.
+                                        # test(lambda format: format == format.upper(),
+                                        #     error = N_(u'Format must contain only uppercase characters')),
+                                        not_none,
                                         ),
-                                    # Don't test capitalization, because CKAN uses sometimes upper and lower characters.
-                                    # test(lambda format: format == format.upper(),
-                                    #     error = N_(u'Format must contain only uppercase characters')),
-                                    not_none,
+                                    'format',
                                     ),
                                 hash = test_none(),
                                 id = pipe(
@@ -654,63 +682,66 @@ cow_json_to_warning_verified_dataset = pipe(
                 ),
             temporal_coverage_from = cow_json_to_year_or_month_or_day_str,
             temporal_coverage_to = cow_json_to_year_or_month_or_day_str,
-            territorial_coverage = pipe(
-                test_isinstance(basestring),
-                function(lambda value: value.split(',')),
-                uniform_sequence(
-                    pipe(
-                        empty_to_none,
-                        test(lambda value: value.count('/') == 2, error = N_(u'Invalid territory')),
-                        function(lambda value: value.split('/')),
-                        struct(
-                            [
-                                pipe(
-                                    empty_to_none,
-                                    test_in(
-                                        [
-                                            u'ArrondissementOfFrance',
-                                            u'AssociatedCommuneOfFrance',
-                                            u'CantonalFractionOfCommuneOfFrance',
-                                            u'CantonCityOfFrance',
-                                            u'CantonOfFrance',
-                                            u'CatchmentAreaOfFrance',
-                                            u'CommuneOfFrance',
-                                            u'Country',
-                                            u'DepartmentOfFrance',
-                                            u'EmploymentAreaOfFrance',
-                                            u'IntercommunalityOfFrance',
-                                            u'InternationalOrganization',
-                                            u'JusticeAreaOfFrance',
-                                            u'MetropoleOfCountry',
-                                            u'Mountain',
-                                            u'OverseasCollectivityOfFrance',
-                                            u'OverseasOfCountry',
-                                            u'PaysOfFrance',
-                                            u'RegionalNatureParkOfFrance',
-                                            u'RegionOfFrance',
-                                            u'UrbanAreaOfFrance',
-                                            u'UrbanTransportsPerimeterOfFrance',
-                                            u'UrbanUnitOfFrance',
-                                            ],
-                                        error = N_(u'Invalid territory type'),
+            territorial_coverage = memoize(
+                pipe(
+                    test_isinstance(basestring),
+                    function(lambda value: value.split(',')),
+                    uniform_sequence(
+                        pipe(
+                            empty_to_none,
+                            test(lambda value: value.count('/') == 2, error = N_(u'Invalid territory')),
+                            function(lambda value: value.split('/')),
+                            struct(
+                                [
+                                    pipe(
+                                        empty_to_none,
+                                        test_in(
+                                            [
+                                                u'ArrondissementOfFrance',
+                                                u'AssociatedCommuneOfFrance',
+                                                u'CantonalFractionOfCommuneOfFrance',
+                                                u'CantonCityOfFrance',
+                                                u'CantonOfFrance',
+                                                u'CatchmentAreaOfFrance',
+                                                u'CommuneOfFrance',
+                                                u'Country',
+                                                u'DepartmentOfFrance',
+                                                u'EmploymentAreaOfFrance',
+                                                u'IntercommunalityOfFrance',
+                                                u'InternationalOrganization',
+                                                u'JusticeAreaOfFrance',
+                                                u'MetropoleOfCountry',
+                                                u'Mountain',
+                                                u'OverseasCollectivityOfFrance',
+                                                u'OverseasOfCountry',
+                                                u'PaysOfFrance',
+                                                u'RegionalNatureParkOfFrance',
+                                                u'RegionOfFrance',
+                                                u'UrbanAreaOfFrance',
+                                                u'UrbanTransportsPerimeterOfFrance',
+                                                u'UrbanUnitOfFrance',
+                                                ],
+                                            error = N_(u'Invalid territory type'),
+                                            ),
+                                        not_none
                                         ),
-                                    not_none
-                                    ),
-                                pipe(
-                                    empty_to_none,
-                                    not_none
-                                    ),
-                                pipe(
-                                    empty_to_none,
-                                    not_none
-                                    ),
-                                ],
+                                    pipe(
+                                        empty_to_none,
+                                        not_none
+                                        ),
+                                    pipe(
+                                        empty_to_none,
+                                        not_none
+                                        ),
+                                    ],
+                                ),
+                            not_none
                             ),
-                        not_none
                         ),
+                    empty_to_none,
+                    not_none,
                     ),
-                empty_to_none,
-                not_none,
+                'territorial_coverage',
                 ),
             territorial_coverage_granularity = pipe(
                 test_isinstance(basestring),
@@ -768,30 +799,39 @@ cow_json_to_warning_verified_dataset = pipe(
     )
 
 
+# Level-3 Converters
+
+
+cow_json_to_existing_dataset = pipe(
+    cow_json_to_dataset,
+    not_none,
+    )
+
+cow_response_to_existing_dataset = pipe(
+    cow_response_to_value,
+    cow_json_to_existing_dataset,
+    )
+
+
 # Functions
 
 
 def check_dataset(dataset):
-    log.debug(u'Checking dataset "{}".'.format(dataset['name']))
-    error_verified_dataset, errors = cow_json_to_error_verified_dataset(dataset, state = default_state)
-    if errors is None:
-        errors = {}
-    warning_verified_dataset, warnings = cow_json_to_warning_verified_dataset(error_verified_dataset,
-        state = default_state)
-    if warnings is None or 'frequency' not in warnings:
-        if warning_verified_dataset[u'frequency'] != u'temps réel':
-            warning_verified_dataset[u'temporal_coverage_from'], error = not_none(
-                warning_verified_dataset[u'temporal_coverage_from'], state = default_state)
-            if error is not None:
-                if warnings is None:
-                    warnings = {}
-                warnings[u'temporal_coverage_from'] = error
+    # Some edits (for example of related links) keep the same revision: The content of the dataset is part of the key.
+    digest = get_dataset_digest(dataset)
+    alerts = get_cached_alerts(dataset, digest)
+    if alerts is None:
+        log.debug(u'Checking dataset "{}".'.format(dataset['name']))
+        errors, warnings = verify_dataset(dataset)
 
-    alerts = {}
-    if errors:
-        alerts['error'] = json.loads(json.dumps(errors))  # Convert numeric keys to strings.
-    if warnings:
-        alerts['warning'] = json.loads(json.dumps(warnings))  # Convert numeric keys to strings.
+        alerts = {}
+        if errors:
+            alerts['error'] = json.loads(json.dumps(errors))  # Convert numeric keys to strings.
+        if warnings:
+            alerts['warning'] = json.loads(json.dumps(warnings))  # Convert numeric keys to strings.
+        put_cached_alerts(dataset, digest, alerts)
+    else:
+        log.debug(u'Retrieving alerts of dataset "{}" from cache.'.format(dataset['name']))
 
     if alerts != dict(
             (level, level_alerts[app_name]['error'])
@@ -832,10 +872,87 @@ def check_dataset(dataset):
             check(cow_response_to_value)(response.read(), state = default_state)
 
 
+def check_dataset_id(dataset_id):
+    # Run in worker processes. Some exceptions (like urllib2.HTTPError) can't be pickled: Return the traceback of the
+    # exception to the main process instead.
+    try:
+        check_dataset(retrieve_dataset(dataset_id))
+    except Exception:
+        return traceback.format_exc()
+    return None
+
+
+def dispatch_message(sequence, dataset_json):
+    # The messages of a dataset are always handled by the same worker, so that they are checked in order.
+    dataset_id = dataset_json.get('id') if isinstance(dataset_json, dict) else None
+    if isinstance(dataset_id, basestring):
+        with messages_lock:
+            sequence_by_dataset_id[dataset_id] = sequence
+    else:
+        dataset_id = None
+    messages_queue = messages_queues[hash(dataset_id) % len(messages_queues)]
+    # Block (with a timeout, to remain interruptible by signals) while the queue is full.
+    while True:
+        try:
+            messages_queue.put((dataset_id, sequence, dataset_json), timeout = 1)
+        except Queue.Full:
+            continue
+        return
+
+
+def format_memoization_statistics(converter):
+    statistics = converter.statistics
+    calls_count = statistics['hits'] + statistics['misses']
+    return 'Memoized converter {}: {} calls of strings, {:.1%} from cache, {} cached values'.format(converter.name,
+        calls_count, float(statistics['hits']) / calls_count if calls_count else 0, len(converter.cache))
+
+
+def get_cached_alerts(dataset, digest):
+    revision_id = dataset.get('revision_id')
+    if cache_db is None or not isinstance(revision_id, basestring):
+        return None
+    with cache_lock:
+        row = cache_db.execute('SELECT alerts FROM alerts WHERE id = ? AND revision_id = ? AND digest = ? '
+            'AND rules_version = ?', (dataset['id'], revision_id, digest, rules_version)).fetchone()
+    return json.loads(row[0]) if row is not None else None
+
+
+def get_dataset_digest(dataset):
+    # The alerts of the dataset are not verified.
+    return hashlib.sha1(json.dumps(dict(
+        (key, value)
+        for key, value in dataset.iteritems()
+        if key != 'alerts'
+        ), sort_keys = True)).hexdigest()
+
+
+def get_rules_version():
+    # Any change of the converters gives a new version.
+    rules_hash = hashlib.sha1()
+    for module in (sys.modules[__name__], memoconv):
+        rules_hash.update(inspect.getsource(module))
+    return rules_hash.hexdigest()
+
+
+def init_worker():
+    # A SQLite connection can't be used across fork(): Each worker process opens its own.
+    global cache_db
+    if not args.no_cache:
+        cache_db = open_cache_db(conf['cache_path'])
+
+
 def main():
     parser = argparse.ArgumentParser(description = __doc__)
     parser.add_argument('config', help = 'path of configuration file')
+    parser.add_argument('-c', '--thread-count', default = 1,
+        help = 'number of threads checking the datasets of fedmsg events', type = int)
     parser.add_argument('-f', '--fedmsg', action = 'store_true', help = 'poll fedmsg events')
+    parser.add_argument('-n', '--no-cache', action = 'store_true',
+        help = 'verify every dataset, even when its revision has already been verified')
+    parser.add_argument('-p', '--processes', default = 1,
+        help = 'number of worker processes used to check every dataset (without --fedmsg)', type = int)
+    parser.add_argument('-q', '--queue-size', default = 0,
+        help = 'max number of fedmsg events waiting for each thread (default: unlimited)', type = int)
     parser.add_argument('-v', '--verbose', action = 'store_true', help = 'increase output verbosity')
 
     global args
@@ -860,6 +977,10 @@ def main():
                         full = True),
                     not_none,
                     ),
+                'cache_path': pipe(
+                    cleanup_line,
+                    default(os.path.join(app_dir, 'data', 'check-datasets-cache.sqlite')),
+                    ),
                 'user_agent': pipe(
                     cleanup_line,
                     not_none,
@@ -870,6 +991,12 @@ def main():
         not_none,
         ))(dict(config_parser.items('CowBots-Check-Datasets')), default_state)
 
+    global cache_db
+    if not args.no_cache:
+        cache_db = open_cache_db(conf['cache_path'])
+    global rules_version
+    rules_version = get_rules_version()
+
     global headers
     headers = {
         'User-Agent': conf['user_agent'],
@@ -915,18 +1042,15 @@ def main():
                 fedmsg_config[key] = value
 
         expected_topic_prefix = '{}.{}.ckan_of_worms.'.format(fedmsg_config['topic_prefix'], fedmsg_config['environment'])
-        for name, endpoint, topic, message in fedmsg.tail_messages(**fedmsg_config):
+        start_workers()
+        for sequence, (name, endpoint, topic, message) in enumerate(fedmsg.tail_messages(**fedmsg_config)):
             if not topic.startswith(expected_topic_prefix):
                 log.debug(u'Ignoring message: {}, {}'.format(topic, name))
                 continue
             kind, action = topic[len(expected_topic_prefix):].split('.')
             if kind == 'dataset':
                 if action in ('create', 'update'):
-                    dataset = check(pipe(
-                        cow_json_to_dataset,
-                        not_none,
-                        ))(message['msg'], state = default_state)
-                    check_dataset(dataset)
+                    dispatch_message(sequence, message['msg'])
                 else:
                     log.debug(u'TODO: Handle {}, {} for {}'.format(kind, action, message))
             else:
@@ -940,19 +1064,118 @@ def main():
             not_none,
             ))(response.read(), state = default_state)
 
-        for dataset_id in datasets_id:
-            request = urllib2.Request(urlparse.urljoin(conf['ckan_of_worms.site_url'],
-                'api/1/datasets/{}'.format(dataset_id)), headers = headers)
-            response = urllib2.urlopen(request)
-            dataset = check(pipe(
-                cow_response_to_value,
-                cow_json_to_dataset,
-                not_none,
-                ))(response.read(), state = default_state)
-            check_dataset(dataset)
+        if args.processes > 1:
+            # Each worker process retrieves, verifies and updates its datasets, so that downloads overlap
+            # verifications. Results are consumed in the order of datasets, so that the first failing dataset (in
+            # this order) stops the scan, like in a sequential scan.
+            if cache_db is not None:
+                # The connection must not be shared with the worker processes.
+                cache_db.close()
+                cache_db = None
+            pool = multiprocessing.Pool(args.processes, initializer = init_worker)
+            try:
+                for exception_traceback in pool.imap(check_dataset_id, datasets_id):
+                    if exception_traceback is not None:
+                        # Report the exception like an exception of a sequential scan.
+                        pool.terminate()
+                        sys.stderr.write(exception_traceback)
+                        return 1
+            except:
+                pool.terminate()
+                raise
+            pool.close()
+            pool.join()
+        else:
+            for dataset_id in datasets_id:
+                check_dataset(retrieve_dataset(dataset_id))
+            for converter in memoconv.memoized_converters:
+                log.info(format_memoization_statistics(converter))
 
     return 0
 
 
+def open_cache_db(path):
+    cache_dir = os.path.dirname(path)
+    if cache_dir and not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    # In fedmsg mode, the connection is shared by worker threads (serialized by cache_lock).
+    db = sqlite3.connect(path, check_same_thread = False, timeout = 60)
+    db.execute('PRAGMA journal_mode = WAL')
+    # Alerts of the latest verified revision of each dataset
+    db.execute('CREATE TABLE IF NOT EXISTS alerts (id TEXT PRIMARY KEY, revision_id TEXT, rules_version TEXT, '
+        'alerts TEXT)')
+    existing_columns_name = set(row[1] for row in db.execute('PRAGMA table_info(alerts)'))
+    if 'digest' not in existing_columns_name:
+        # Alerts cached before the digest was part of the key are verified again.
+        db.execute('ALTER TABLE alerts ADD COLUMN digest TEXT')
+    db.commit()
+    return db
+
+
+def put_cached_alerts(dataset, digest, alerts):
+    revision_id = dataset.get('revision_id')
+    if cache_db is None or not isinstance(revision_id, basestring):
+        return
+    with cache_lock:
+        cache_db.execute('INSERT OR REPLACE INTO alerts (id, revision_id, digest, rules_version, alerts) '
+            'VALUES (?, ?, ?, ?, ?)', (dataset['id'], revision_id, digest, rules_version, json.dumps(alerts)))
+        cache_db.commit()
+
+
+def retrieve_dataset(dataset_id):
+    request = urllib2.Request(urlparse.urljoin(conf['ckan_of_worms.site_url'],
+        'api/1/datasets/{}'.format(dataset_id)), headers = headers)
+    response = urllib2.urlopen(request)
+    return check(cow_response_to_existing_dataset)(response.read(), state = default_state)
+
+
+def run_worker(messages_queue):
+    while True:
+        dataset_id, sequence, dataset_json = messages_queue.get()
+        if dataset_id is not None:
+            with messages_lock:
+                latest_sequence = sequence_by_dataset_id.get(dataset_id)
+            if latest_sequence != sequence:
+                # A newer revision of the dataset is waiting in queue: Skip this one.
+                log.debug(u'Skipping superseded message {} of dataset {}'.format(sequence, dataset_id))
+                continue
+        try:
+            dataset = check(cow_json_to_existing_dataset)(dataset_json, state = default_state)
+            check_dataset(dataset)
+        except:
+            log.exception(u'An exception occurred for message {} of dataset {}'.format(sequence, dataset_id))
+        finally:
+            if dataset_id is not None:
+                with messages_lock:
+                    if sequence_by_dataset_id.get(dataset_id) == sequence:
+                        del sequence_by_dataset_id[dataset_id]
+
+
+def start_workers():
+    for index in range(max(args.thread_count, 1)):
+        messages_queue = Queue.Queue(args.queue_size)
+        messages_queues.append(messages_queue)
+        worker = threading.Thread(name = 'worker-{}'.format(index), target = run_worker, args = (messages_queue,))
+        worker.daemon = True
+        worker.start()
+
+
+def verify_dataset(dataset):
+    error_verified_dataset, errors = cow_json_to_error_verified_dataset(dataset, state = default_state)
+    if errors is None:
+        errors = {}
+    warning_verified_dataset, warnings = cow_json_to_warning_verified_dataset(error_verified_dataset,
+        state = default_state)
+    if warnings is None or 'frequency' not in warnings:
+        if warning_verified_dataset[u'frequency'] != u'temps réel':
+            warning_verified_dataset[u'temporal_coverage_from'], error = not_none(
+                warning_verified_dataset[u'temporal_coverage_from'], state = default_state)
+            if error is not None:
+                if warnings is None:
+                    warnings = {}
+                warnings[u'temporal_coverage_from'] = error
+    return errors, warnings
+
+
 if __name__ == '__main__':
     sys.exit(main())
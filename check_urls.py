@@ -28,28 +28,201 @@
 
 
 import argparse
+import bisect
+import collections
 import ConfigParser
-import datetime
+import ftplib
+import hashlib
+import heapq
+import httplib
 import json
 import logging
 import os
+import Queue
+import re
+import signal
 import socket
+import sqlite3
+import ssl
 import sys
-import thread
+import threading
 import time
+import urllib
 import urllib2
 import urlparse
 
 from biryani1 import baseconv, custom_conv, jsonconv, states
 
 
+app_dir = os.path.dirname(os.path.abspath(__file__))
 app_name = os.path.splitext(os.path.basename(__file__))[0]
-cache_by_url = {}
+breaker_by_host = {}  # Consecutive failures & circuit state of failing hosts
+breakers_lock = threading.Lock()
+cache_by_url = collections.OrderedDict()  # Least recently used URL first
+cache_by_url_lock = threading.Lock()
+cache_by_url_max_size = 100000
+cache_by_url_purge_interval = 60  # seconds
+cache_by_url_purged = 0
+cache_by_url_statistics = dict(
+    evictions = 0,
+    expirations = 0,
+    hits = 0,
+    misses = 0,
+    )
+cache_db = None
+cache_lock = threading.Lock()
 conf = None
+db_threadpool = None  # Native thread running SQLite queries, with gevent engine
+connections_by_server = {}  # Idle connections by (scheme, host, port), most recently released last
+connections_lock = threading.Lock()
+connections_purged = 0
 conv = custom_conv(baseconv, jsonconv, states)
+dataset_by_id = {}  # Stripped datasets, in daemon mode
+datasets_id_by_url = {}  # In daemon mode
+default_port_by_scheme = {
+    u'ftp': 21,
+    u'ftps': 21,  # Explicit FTPS (AUTH TLS)
+    u'http': 80,
+    u'https': 443,
+    }
+tasks_queue = None
 headers = None
+hosts_condition = None
 log = logging.getLogger(app_name)
-pool = set()
+max_redirects = 10
+metrics_bounds = dict(
+    # Upper bounds of histograms buckets (the last bucket counts the greater values)
+    content_length = (1024, 10 * 1024, 100 * 1024, 1024 ** 2, 10 * 1024 ** 2, 100 * 1024 ** 2, 1024 ** 3),  # bytes
+    duration = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60),  # seconds
+    redirect_count = (0, 1, 2, 3, 5),
+    ttfb = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60),  # seconds
+    )
+metrics_by_host = {}  # Histograms of response metrics, by host
+metrics_lock = threading.Lock()
+ogc_request_parameters = frozenset([
+    # Parameters identifying a request to an OGC service (as opposed to parameters identifying the service itself,
+    # like MapServer "map"), in lower case
+    'acceptformats',
+    'acceptversions',
+    'bbox',
+    'bgcolor',
+    'count',
+    'coverage',
+    'coverageid',
+    'crs',
+    'elevation',
+    'exceptions',
+    'feature_count',
+    'featureid',
+    'filter',
+    'format',
+    'height',
+    'i',
+    'info_format',
+    'interpolation',
+    'j',
+    'layer',
+    'layers',
+    'maxfeatures',
+    'outputformat',
+    'propertyname',
+    'query_layers',
+    'request',
+    'resultformat',
+    'resulttype',
+    'resx',
+    'resy',
+    'sections',
+    'service',
+    'sld',
+    'sld_body',
+    'srs',
+    'srsname',
+    'startindex',
+    'style',
+    'styles',
+    'tilecol',
+    'tilematrix',
+    'tilematrixset',
+    'tilerow',
+    'time',
+    'transparent',
+    'typename',
+    'typenames',
+    'version',
+    'width',
+    'x',
+    'y',
+    ])
+ogc_script_extensions = frozenset([u'.asp', u'.aspx', u'.cgi', u'.dll', u'.exe', u'.fcgi', u'.map', u'.php', u'.py'])
+ogc_services = (u'WCS', u'WFS', u'WMS', u'WMTS')
+percent_encoded_re = re.compile(ur'%([0-9A-Fa-f]{2})')
+redirect_statuses = (301, 302, 303, 307, 308)
+schedule_lock = threading.Lock()
+shard = None  # (index, count) of the hosts checked by this process, when the checking is shared between processes
+shard_urls_count = 0  # Number of URLs checked by this shard, in daemon mode
+slot_by_host = {}
+unreserved_characters = frozenset(u'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-._~')
+url_check_columns = (
+    ('status', 'INTEGER'),
+    ('error', 'TEXT'),
+    ('checked', 'REAL'),
+    ('expires', 'REAL'),
+    ('etag', 'TEXT'),
+    ('last_modified', 'TEXT'),
+    ('changed', 'REAL'),
+    ('ttfb', 'REAL'),
+    ('duration', 'REAL'),
+    ('content_length', 'INTEGER'),
+    ('redirect_count', 'INTEGER'),
+    ('breaker', 'INTEGER'),  # 1 when the URL was not checked, because the circuit breaker of its host was open
+    )
+url_checks_in_flight = {}  # Event & result of each URL check in progress, by URL
+url_checks_in_flight_lock = threading.Lock()
+urls_schedule = []  # Heap of (due time, URL), in daemon mode
+workers = []
+workers_busy_count = 0
+workers_busy_time = 0.0  # Total number of seconds spent by workers checking datasets
+workers_lock = threading.Lock()
+
+
+# Classes
+
+
+class DeadlineSocket(object):
+    # Socket wrapper that bounds every blocking operation by the read timeout and by the deadline of the current URL
+    # check, so that a server sending its response byte after byte can't hold a worker.
+    deadline = None
+
+    def __init__(self, sock):
+        self.sock = sock
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+    def makefile(self, mode = 'r', bufsize = -1):
+        # The file must read through a wrapper, not from the wrapped socket directly. Like socket.makefile, the file
+        # must also keep the connection open after the socket has been closed: httplib closes it as soon as the
+        # headers of a response have been received, when the server closes the connection after the body.
+        if isinstance(self.sock, ssl.SSLSocket):
+            # SSL sockets count their files and are really closed when the last one is closed.
+            self.sock._makefile_refs += 1
+            file_socket = DeadlineSocket(self.sock)
+            close = True
+        else:
+            # A new socket object sharing the same system socket, like socket.makefile (and gevent) do.
+            file_socket = DeadlineSocket(type(self.sock)(_sock = self.sock._sock))
+            close = False
+        file_socket.deadline = self.deadline
+        return socket._fileobject(file_socket, mode, bufsize, close = close)
+
+    def recv(self, *arguments):
+        self.sock.settimeout(get_timeout(args.read_timeout, self.deadline))
+        return self.sock.recv(*arguments)
+
+    def sendall(self, *arguments):
+        self.sock.settimeout(get_timeout(args.read_timeout, self.deadline))
+        return self.sock.sendall(*arguments)
 
 
 # Converters
@@ -81,16 +254,122 @@ cow_response_to_value = conv.pipe(
     conv.function(lambda response: response['value']),
     )
 
+input_to_checkable_url = conv.make_input_to_url(full = True, schemes = (u'ftp', u'ftps', u'http', u'https'))
+
+
+def make_input_to_checkable_url(format = None):
+    return conv.pipe(
+        input_to_checkable_url,
+        conv.function(lambda url: to_ogc_capabilities_url(url, format = format)),
+        conv.function(canonicalize_url),
+        )
+
 
 # Functions
 
 
-def check_dataset_urls(dataset):
+def acquire_host_slot(host):
+    # Wait until the host has a free connection slot and its last request started at least host_delay seconds ago,
+    # while letting the other workers check URLs of other hosts.
+    with hosts_condition:
+        while True:
+            now = time.time()
+            host_slot = slot_by_host.get(host)
+            if host_slot is None:
+                host_slot = slot_by_host[host] = dict(active_count = 0, next_start = now)
+            delay = host_slot['next_start'] - now
+            if host_slot['active_count'] < args.host_concurrency and delay <= 0:
+                host_slot['active_count'] += 1
+                host_slot['next_start'] = now + args.host_delay
+                return
+            hosts_condition.wait(delay if delay > 0 else None)
+
+
+def call_db(function, *arguments):
+    # With gevent, a SQLite query waiting for the lock of a database shared with other processes would block every
+    # greenlet: Run it in a native thread instead.
+    if db_threadpool is not None:
+        return db_threadpool.apply(function, arguments)
+    return function(*arguments)
+
+
+def canonicalize_url(url):
+    # Normalize the URL, so that equivalent URLs share the same cache entry: lower case scheme & host, no default
+    # port, no empty query, no fragment and percent-encoding only for non unreserved characters (in upper case).
+    split_url = urlparse.urlsplit(url)
+    scheme = split_url.scheme.lower()
+    try:
+        port = split_url.port
+    except ValueError:
+        return url
+    host = split_url.hostname or u''
+    netloc = u'[{}]'.format(host) if u':' in host else host
+    if port is not None and port != default_port_by_scheme.get(scheme):
+        netloc = u'{}:{}'.format(netloc, port)
+    userinfo, at, hostport = split_url.netloc.rpartition(u'@')
+    if at:
+        netloc = u'{}@{}'.format(userinfo, netloc)
+    path = normalize_percent_encoding(split_url.path)
+    if not path and scheme in (u'http', u'https'):
+        path = u'/'
+    return urlparse.urlunsplit((scheme, netloc, path, normalize_percent_encoding(split_url.query), u''))
+
+
+def check_all_datasets():
+    # First retrieve every dataset and collect the distinct URLs they reference, so that each URL is checked only
+    # once during the scan, however many datasets reference it.
+    datasets = []
+    urls = set()
+    for dataset in iter_datasets():
+        if is_in_shard(dataset['id']):
+            datasets.append(strip_dataset(dataset))
+        urls.update(url for url in iter_dataset_urls(dataset) if is_url_in_shard(url))
+
+    log.info(u'Checking {} distinct URLs of {} datasets.'.format(len(urls), len(datasets)))
+    error_by_url = {}
+
+    def validate_and_keep_url(url):
+        error_by_url[url] = validate_url(url)[1]
+
+    for url in urls:
+        enqueue_task(validate_and_keep_url, url)
+    tasks_queue.join()
+
+    # Then update the alerts of each dataset from the results of the scan.
+    def validate_scanned_url(url, state = None, deadline = None):
+        if url in error_by_url:
+            return url, error_by_url[url]
+        return validate_url(url, state = state, deadline = deadline)
+
+    for dataset in datasets:
+        enqueue_task(check_dataset_urls, dataset, validate_scanned_url)
+
+
+def check_dataset_urls(dataset, url_validator = None):
+    if url_validator is None:
+        url_validator = validate_url
+    if not is_in_shard(dataset['id']):
+        # The alerts of this dataset are posted by another shard: Only check the URLs of this shard.
+        for url in iter_dataset_urls(dataset):
+            if is_url_in_shard(url):
+                url_validator(url)
+        return
     log.debug(u'Checking URLs of dataset "{}".'.format(dataset['name']))
+    deadline = time.time() + args.dataset_timeout
+    unchecked_error = conv.default_state._(u'The URL has not been checked in time.')
+
+    def validate_url_before_deadline(url, state = None):
+        if url is not None and time.time() >= deadline:
+            url_check = load_url_check(url)
+            if url_check is None or url_check['expires'] <= time.time():
+                # Don't let a dataset with many slow URLs hold the worker: Report the remaining URLs as unchecked.
+                return url, unchecked_error
+        return url_validator(url, state = state, deadline = deadline)
+
     errors = {}
     url, error = conv.pipe(
-        conv.make_input_to_url(full = True, schemes = (u'ftp', u'ftps', u'http', u'https')),
-        validate_url,
+        make_input_to_checkable_url(),
+        validate_url_before_deadline,
         )(dataset.get('url'),
         state = conv.default_state)
     if error is not None:
@@ -101,15 +380,15 @@ def check_dataset_urls(dataset):
         related_link_errors = related_links_errors.get(related_link_index) or {}
 
         image_url, error = conv.pipe(
-            conv.make_input_to_url(full = True, schemes = (u'ftp', u'ftps', u'http', u'https')),
-            validate_url,
+            make_input_to_checkable_url(),
+            validate_url_before_deadline,
             )(related_link.get('image_url'), state = conv.default_state)
         if error is not None:
             related_link_errors['image_url'] = error
 
         url, error = conv.pipe(
-            conv.make_input_to_url(full = True, schemes = (u'ftp', u'ftps', u'http', u'https')),
-            validate_url,
+            make_input_to_checkable_url(),
+            validate_url_before_deadline,
             )(related_link.get('url'),
             state = conv.default_state)
         if error is not None:
@@ -127,8 +406,8 @@ def check_dataset_urls(dataset):
         resource_errors = resources_errors.get(resource_index) or {}
 
         url, error = conv.pipe(
-            conv.make_input_to_url(full = True, schemes = (u'ftp', u'ftps', u'http', u'https')),
-            validate_url,
+            make_input_to_checkable_url(format = resource.get('format')),
+            validate_url_before_deadline,
             )(resource.get('url'),
             state = conv.default_state)
         if error is not None:
@@ -141,9 +420,13 @@ def check_dataset_urls(dataset):
     if resources_errors:
         errors['resources'] = resources_errors
 
+    warnings = pop_errors(errors, unchecked_error)
+
     alerts = {}
     if errors:
         alerts['error'] = json.loads(json.dumps(errors))  # Convert numeric keys to strings.
+    if warnings:
+        alerts['warning'] = json.loads(json.dumps(warnings))  # Convert numeric keys to strings.
 
     if alerts != dict(
             (level, level_alerts[app_name]['error'])
@@ -182,27 +465,330 @@ def check_dataset_urls(dataset):
         else:
             assert response.code == 200
             conv.check(cow_response_to_value)(response.read(), state = conv.default_state)
+            # Remember the alerts sent, for the next checks of the same dataset (in daemon mode).
+            dataset['alerts'] = dict(
+                (level, {app_name: dict(error = level_alerts)})
+                for level, level_alerts in alerts.iteritems()
+                )
 
 
-def check_dataset_urls_in_thread(dataset):
+def check_url(url, state, previous_url_check = None):
+    url_check = dict(
+        checked = time.time(),
+        )
     try:
-        check_dataset_urls(dataset)
+        probe = probe_url(url, url_check['checked'] + args.url_timeout, previous_url_check = previous_url_check)
+    except socket.timeout as exception:
+        url_check['error'] = state._(u'A timeout error occured when trying to connect to the web server: {0}').format(
+            exception)
+        url_check['unreachable'] = True
+    except (EOFError, httplib.HTTPException, socket.error) as exception:
+        # Format connection errors like urllib2 did, so that existing alerts remain unchanged.
+        url_check['error'] = state._(u'An error occured when trying to connect to the web server: {0}').format(
+            urllib2.URLError(exception))
+        url_check['unreachable'] = True
+    except urllib2.URLError as exception:
+        url_check['error'] = state._(u'An error occured when trying to connect to the web server: {0}').format(
+            exception)
     except:
-        log.exception(u'An exception occurred for {0}'.format(dataset))
-    finally:
-        pool.discard(thread.get_ident())
+        url_check['error'] = state._(u'An error occured when trying to connect to the web server: {0}').format(
+            sys.exc_info()[0])
+    else:
+        status = url_check['status'] = probe['status']
+        url_check['redirect_urls'] = probe.get('redirect_urls')
+        url_check['etag'] = probe.get('etag')
+        url_check['last_modified'] = probe.get('last_modified')
+        url_check['ttfb'] = probe.get('ttfb')
+        url_check['content_length'] = probe.get('content_length')
+        url_check['redirect_count'] = len(probe.get('redirect_urls') or [])
+        if status == 304 and previous_url_check is not None:
+            # Not modified since previous check: The resource is still available.
+            url_check['etag'] = url_check['etag'] or previous_url_check.get('etag')
+            url_check['last_modified'] = url_check['last_modified'] or previous_url_check.get('last_modified')
+        elif status is None or status < 300 or status == 416:
+            # 416 (requested range not satisfiable) means that the resource exists but is empty.
+            pass
+        elif status < 400:
+            url_check['error'] = state._(
+                u'An error occured when trying to connect to the web server: {0:d} {1}').format(status, probe['reason'])
+        else:
+            url_check['error'] = state._(u'The web server responded with a bad status code: {0:d} {1}').format(
+                status, probe['reason'])
+    url_check['duration'] = time.time() - url_check['checked']
+    return url_check
+
+
+def enqueue_task(function, *arguments):
+    # Block (with a timeout, to remain interruptible by signals) while the queue is full, so that a slow checking
+    # doesn't let pending tasks pile up in memory.
+    while True:
+        try:
+            tasks_queue.put((function, arguments), timeout = 1)
+        except Queue.Full:
+            continue
+        return
+
+
+def get_cached_url_check(url):
+    now = time.time()
+    with cache_by_url_lock:
+        if now - cache_by_url_purged >= cache_by_url_purge_interval:
+            purge_cached_url_checks(now)
+        url_check = cache_by_url.pop(url, None)
+        if url_check is None:
+            cache_by_url_statistics['misses'] += 1
+            return None
+        # Reinsert URL check to mark it as the most recently used.
+        cache_by_url[url] = url_check
+        if url_check['expires'] <= now:
+            # Return expired URL check anyway, because its validators (ETag, etc) are used to recheck the URL. It is
+            # counted as expired only when purged.
+            cache_by_url_statistics['misses'] += 1
+        else:
+            cache_by_url_statistics['hits'] += 1
+        return url_check
+
+
+def get_connection(server, create_connection):
+    global connections_purged
+    now = time.time()
+    with connections_lock:
+        if now - connections_purged >= args.pool_idle_timeout:
+            connections_purged = now
+            for idle_connections in connections_by_server.itervalues():
+                while idle_connections and now - idle_connections[0][1] >= args.pool_idle_timeout:
+                    idle_connections.pop(0)[0].close()
+        idle_connections = connections_by_server.get(server)
+        while idle_connections:
+            connection, release_time = idle_connections.pop()
+            if now - release_time < args.pool_idle_timeout:
+                return connection, True
+            connection.close()
+    return create_connection(), False
+
+
+def get_content_length(response):
+    # Return the full size of the resource, even when the response contains only a range of it.
+    content_range = response.getheader('content-range')
+    if content_range is not None:
+        total = content_range.rpartition('/')[2].strip()
+        return int(total) if total.isdigit() else None
+    content_length = response.getheader('content-length')
+    if content_length is None or not content_length.strip().isdigit() or response.status == 304:
+        return None
+    return int(content_length)
+
+
+def get_open_breaker(host):
+    # Return the circuit breaker of the host when it is open, ie when host must not be requested.
+    with breakers_lock:
+        breaker = breaker_by_host.get(host)
+        if breaker is None or breaker['failure_count'] < args.breaker_threshold:
+            return None
+        if breaker['probing'] or time.time() < breaker['open_until']:
+            return breaker
+        # Half-open circuit: Let a single request probe the host.
+        breaker['probing'] = True
+        return None
+
+
+def get_timeout(timeout, deadline):
+    remaining = deadline - time.time()
+    if remaining <= 0:
+        raise socket.timeout('URL check has exceeded its time budget of {} seconds'.format(args.url_timeout))
+    return min(timeout, remaining)
+
+
+def index_datasets():
+    # (Re)load the catalogue and schedule the URLs that are not scheduled yet.
+    global dataset_by_id, datasets_id_by_url
+    new_dataset_by_id = {}
+    new_datasets_id_by_url = {}
+    for dataset in iter_datasets():
+        if is_in_shard(dataset['id']):
+            new_dataset_by_id[dataset['id']] = strip_dataset(dataset)
+            for url in iter_dataset_urls(dataset):
+                new_datasets_id_by_url.setdefault(url, set()).add(dataset['id'])
+        else:
+            # Check the URLs of this shard, even when they are used only by datasets of other shards.
+            for url in iter_dataset_urls(dataset):
+                if is_url_in_shard(url):
+                    new_datasets_id_by_url.setdefault(url, set())
+    period = args.daemon_period * 3600
+    now = time.time()
+    for url in new_datasets_id_by_url:
+        if url in datasets_id_by_url:
+            continue
+        url_check = load_url_check(url)
+        with schedule_lock:
+            heapq.heappush(urls_schedule, (
+                min(url_check['expires'], url_check['checked'] + period) if url_check is not None else now,
+                url,
+                ))
+    dataset_by_id = new_dataset_by_id
+    datasets_id_by_url = new_datasets_id_by_url
+    global shard_urls_count
+    shard_urls_count = sum(1 for url in datasets_id_by_url if is_url_in_shard(url))
+    log.info(u'Scheduling the check of {} URLs of {} datasets.'.format(len(datasets_id_by_url), len(dataset_by_id)))
+
+
+def is_in_shard(key):
+    if shard is None:
+        return True
+    index, count = shard
+    # Use a stable hash, shared by every process.
+    return int(hashlib.md5(key.encode('utf-8')).hexdigest(), 16) % count == index
+
+
+def is_url_in_shard(url):
+    # URLs are shared between processes by host, so that each web server is requested by a single process.
+    return is_in_shard(urlparse.urlsplit(url).hostname or u'')
+
+
+def iter_dataset_urls(dataset):
+    raw_urls_and_formats = [(dataset.get('url'), None)]
+    for related_link in dataset.get('related') or []:
+        raw_urls_and_formats.append((related_link.get('image_url'), None))
+        raw_urls_and_formats.append((related_link.get('url'), None))
+    for resource in dataset.get('resources') or []:
+        raw_urls_and_formats.append((resource.get('url'), resource.get('format')))
+    for raw_url, format in raw_urls_and_formats:
+        url, error = make_input_to_checkable_url(format = format)(raw_url, state = conv.default_state)
+        if url is not None and error is None:
+            yield url
+
+
+def iter_datasets():
+    request = urllib2.Request(urlparse.urljoin(conf['ckan_of_worms.site_url'], 'api/1/datasets'), headers = headers)
+    response = urllib2.urlopen(request)
+    datasets_id = conv.check(conv.pipe(
+        cow_response_to_value,
+        conv.not_none,
+        ))(response.read(), state = conv.default_state)
+    for dataset_id in datasets_id:
+        request = urllib2.Request(urlparse.urljoin(conf['ckan_of_worms.site_url'],
+            'api/1/datasets/{}'.format(dataset_id)), headers = headers)
+        response = urllib2.urlopen(request)
+        yield conv.check(conv.pipe(
+            cow_response_to_value,
+            conv.not_none,
+            ))(response.read(), state = conv.default_state)
+
+
+def load_url_check(url):
+    # Return the latest known check of URL, even when it has expired.
+    url_check = get_cached_url_check(url)
+    if url_check is not None and url_check['expires'] > time.time():
+        return url_check
+    if cache_db is not None:
+        # Another check_urls process may have checked the URL more recently.
+        row = call_db(read_url_check_row, url)
+        if row is not None:
+            db_url_check = dict(zip((name for name, type in url_check_columns), row))
+            if url_check is None or db_url_check['checked'] > url_check['checked']:
+                url_check = db_url_check
+                put_cached_url_check(url, url_check)
+    return url_check
+
+
+def log_workers_statistics():
+    last_busy_time = 0.0
+    while True:
+        time.sleep(args.statistics_interval)
+        with workers_lock:
+            busy_count = workers_busy_count
+            busy_time = workers_busy_time
+        # Workers may have been stopped meanwhile.
+        workers_count = len(workers)
+        log.info(u'Workers: {} busy out of {}, {:.0%} utilisation, {} tasks waiting in queue'.format(busy_count,
+            workers_count, (busy_time - last_busy_time) / (args.statistics_interval * max(workers_count, 1)),
+            tasks_queue.qsize()))
+        last_busy_time = busy_time
+        if args.metrics_file is not None:
+            write_metrics(args.metrics_file)
 
 
 def main():
     parser = argparse.ArgumentParser(description = __doc__)
     parser.add_argument('config', help = 'path of configuration file')
+    parser.add_argument('--breaker-backoff', default = 60,
+        help = 'number of seconds during which a failing host is no longer requested (doubled after each failure)',
+        type = int)
+    parser.add_argument('--breaker-max-backoff', default = 3600,
+        help = 'max number of seconds during which a failing host is no longer requested', type = int)
+    parser.add_argument('--breaker-threshold', default = 5,
+        help = 'number of consecutive failures of a host before it is no longer requested', type = int)
+    parser.add_argument('--connect-timeout', default = 10,
+        help = 'max number of seconds to connect to a server', type = float)
     parser.add_argument('-c', '--thread-count', default = 1, help = 'max number of threads', type = int)
+    parser.add_argument('--dataset-timeout', default = 600, help = 'max number of seconds to check the URLs of a '
+        'dataset: when it is exceeded, the remaining URLs are reported as unchecked', type = float)
+    parser.add_argument('-d', '--daemon', action = 'store_true',
+        help = 'check continuously every URL of every dataset, at a steady rate')
+    parser.add_argument('--daemon-period', default = 24.0,
+        help = 'number of hours during which every URL is checked in daemon mode', type = float)
+    parser.add_argument('-e', '--engine', choices = ['gevent', 'threads'], default = 'threads',
+        help = 'concurrency engine used by workers ("gevent" allows thousands of concurrent checks)')
     parser.add_argument('-f', '--fedmsg', action = 'store_true', help = 'poll fedmsg events')
+    parser.add_argument('--host-concurrency', default = 2,
+        help = 'max number of concurrent requests to the same host', type = int)
+    parser.add_argument('--host-delay', default = 0.0,
+        help = 'min number of seconds between the starts of two requests to the same host', type = float)
+    parser.add_argument('-m', '--metrics-file',
+        help = 'path of JSON file where histograms of response metrics by host are written periodically')
+    parser.add_argument('--max-ttl', default = 7 * 24 * 3600,
+        help = 'max number of seconds before an URL that has always been valid is checked again', type = int)
+    parser.add_argument('--min-ttl', default = 5 * 60,
+        help = 'min number of seconds before an URL is checked again', type = int)
+    parser.add_argument('-p', '--pool-size', default = 4,
+        help = 'max number of idle keep-alive connections kept for each web server', type = int)
+    parser.add_argument('--pool-idle-timeout', default = 30,
+        help = 'number of seconds after which an idle keep-alive connection is closed', type = int)
+    parser.add_argument('-q', '--queue-size', help = 'max number of tasks waiting for a worker (default: twice the '
+        'number of threads)', type = int)
+    parser.add_argument('-r', '--read-size', default = 16384,
+        help = 'max number of bytes downloaded when a GET is needed to check an URL', type = int)
+    parser.add_argument('--shard', help = 'check only the URLs whose host belongs to shard INDEX (from 1 to COUNT) and '
+        'post only the alerts of the datasets of this shard, merging the results of the other shards through the '
+        'shared cache', metavar = 'INDEX/COUNT')
+    parser.add_argument('--shard-timeout', default = 3600,
+        help = 'max number of seconds to wait for an URL to be checked by another shard', type = int)
+    parser.add_argument('--read-timeout', default = 30,
+        help = 'max number of seconds to wait for data from a server', type = float)
+    parser.add_argument('-s', '--cache-size', default = 100000,
+        help = 'max number of URL checks kept in memory', type = int)
+    parser.add_argument('-t', '--statistics-interval', default = 60,
+        help = 'number of seconds between two logs of workers statistics', type = int)
+    parser.add_argument('-u', '--url-timeout', default = 60,
+        help = 'max total number of seconds to check an URL, redirections included', type = float)
     parser.add_argument('-v', '--verbose', action = 'store_true', help = 'increase output verbosity')
 
     global args
     args = parser.parse_args()
     logging.basicConfig(level = logging.DEBUG if args.verbose else logging.WARNING, stream = sys.stdout)
+    if args.thread_count < 1:
+        parser.error(u'argument -c/--thread-count: invalid value: {}'.format(args.thread_count))
+
+    global shard
+    if args.shard is not None:
+        match = re.match(r'(\d+)/(\d+)$', args.shard)
+        if match is None or not 1 <= int(match.group(1)) <= int(match.group(2)):
+            parser.error(u'argument --shard: invalid value: {}'.format(args.shard))
+        shard = (int(match.group(1)) - 1, int(match.group(2)))
+
+    if args.engine == 'gevent':
+        import gevent.monkey
+
+        # Turn sockets, threads, queues & sleeps into cooperative greenlets, so that each worker costs only a few
+        # kilobytes and waiting for slow web servers doesn't hold any OS thread. The locks created at import time
+        # stay native locks, which is harmless because no blocking I/O occurs while they are held, except for SQLite
+        # queries, that run in a native thread.
+        gevent.monkey.patch_all()
+        import gevent.threadpool
+        global db_threadpool
+        db_threadpool = gevent.threadpool.ThreadPool(1)
+    global hosts_condition
+    hosts_condition = threading.Condition()
 
     config_parser = ConfigParser.SafeConfigParser(dict(
         here = os.path.dirname(os.path.abspath(os.path.normpath(args.config))),
@@ -222,6 +808,10 @@ def main():
                         full = True),
                     conv.not_none,
                     ),
+                'cache_path': conv.pipe(
+                    conv.cleanup_line,
+                    conv.default(os.path.join(app_dir, 'data', 'check-urls-cache.sqlite')),
+                    ),
                 'user_agent': conv.pipe(
                     conv.cleanup_line,
                     conv.not_none,
@@ -232,126 +822,726 @@ def main():
         conv.not_none,
         ))(dict(config_parser.items('CowBots-Check-URLs')), conv.default_state)
 
+    global cache_by_url_max_size
+    cache_by_url_max_size = args.cache_size
+    global cache_db
+    cache_db = open_cache_db(conf['cache_path'])
+
     global headers
     headers = {
         'User-Agent': conf['user_agent'],
         }
 
-    if args.fedmsg:
-        import fedmsg
+    # Convert SIGTERM to an exception, to let pending datasets be checked before exiting.
+    signal.signal(signal.SIGTERM, lambda signal_number, frame: sys.exit(0))
+    start_workers()
+    try:
+        if args.daemon:
+            run_daemon()
+        elif args.fedmsg:
+            poll_fedmsg(config_parser)
+        else:
+            check_all_datasets()
+    finally:
+        stop_workers()
 
-        fedmsg_conf = conv.check(conv.struct(
-            dict(
-                environment = conv.pipe(
-                    conv.empty_to_none,
-                    conv.test_in(['dev', 'prod', 'stg']),
-                    ),
-                modname = conv.pipe(
-                    conv.empty_to_none,
-                    conv.test(lambda value: value == value.strip('.'), error = 'Value must not begin or end with a "."'),
-                    conv.default('ckan_of_worms'),
-                    ),
-#                name = conv.pipe(
-#                    conv.empty_to_none,
-#                    conv.default('ckan_of_worms.{}'.format(hostname)),
-#                    ),
-                topic_prefix = conv.pipe(
-                    conv.empty_to_none,
-                    conv.test(lambda value: value == value.strip('.'), error = 'Value must not begin or end with a "."'),
-                    ),
+    return 0
+
+
+def normalize_percent_encoding(text):
+    def normalize_percent_encoded_character(match):
+        character = unichr(int(match.group(1), 16))
+        return character if character in unreserved_characters else u'%' + match.group(1).upper()
+
+    return percent_encoded_re.sub(normalize_percent_encoded_character, text)
+
+
+def open_cache_db(path):
+    cache_dir = os.path.dirname(path)
+    if cache_dir and not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    # The connection is shared by checker threads (serialized by cache_lock) and the database file may be shared by
+    # several check_urls processes, hence the busy timeout and the write-ahead log that lets readers run concurrently.
+    db = sqlite3.connect(path, check_same_thread = False, timeout = 60)
+    db.execute('PRAGMA journal_mode = WAL')
+    db.execute('CREATE TABLE IF NOT EXISTS url_checks (url TEXT PRIMARY KEY)')
+    existing_columns_name = set(row[1] for row in db.execute('PRAGMA table_info(url_checks)'))
+    for name, type in url_check_columns:
+        if name not in existing_columns_name:
+            db.execute('ALTER TABLE url_checks ADD COLUMN {} {}'.format(name, type))
+    db.commit()
+    return db
+
+
+def open_ftp_connection(server, password, deadline):
+    scheme, host, port, user, password_hash = server
+    connection = ftplib.FTP_TLS() if scheme == u'ftps' else ftplib.FTP()
+    connection.connect(host, port, timeout = get_timeout(args.connect_timeout, deadline))
+    try:
+        connection.login(user, password)
+        if scheme == u'ftps':
+            connection.prot_p()
+        # Many FTP servers refuse SIZE in ASCII mode.
+        connection.voidcmd('TYPE I')
+        connection.home_directory = connection.pwd()
+        connection.sock = DeadlineSocket(connection.sock)
+        connection.file = connection.sock.makefile('rb')
+    except ftplib.error_perm as exception:
+        connection.close()
+        raise urllib2.URLError('ftp error: {}'.format(exception))
+    except:
+        connection.close()
+        raise
+    return connection
+
+
+def open_http_connection(server, deadline):
+    scheme, host, port = server
+    connection_class = httplib.HTTPSConnection if scheme == u'https' else httplib.HTTPConnection
+    connection = connection_class(host, port, timeout = get_timeout(args.connect_timeout, deadline))
+    connection.connect()
+    connection.sock = DeadlineSocket(connection.sock)
+    return connection
+
+
+def poll_fedmsg(config_parser):
+    import fedmsg
+
+    fedmsg_conf = conv.check(conv.struct(
+        dict(
+            environment = conv.pipe(
+                conv.empty_to_none,
+                conv.test_in(['dev', 'prod', 'stg']),
                 ),
-            default = 'drop',
-            ))(dict(config_parser.items('fedmsg')))
-
-        # Read in the config from /etc/fedmsg.d/.
-        fedmsg_config = fedmsg.config.load_config([], None)
-        # Disable a warning about not sending.  We know.  We only want to tail.
-        fedmsg_config['mute'] = True
-        # Disable timing out so that we can tail forever.  This is deprecated
-        # and will disappear in future versions.
-        fedmsg_config['timeout'] = 0
-        # For the time being, don't require message to be signed.
-        fedmsg_config['validate_signatures'] = False
-        for key, value in fedmsg_conf.iteritems():
-            if value is not None:
-                fedmsg_config[key] = value
-
-        expected_topic_prefix = '{}.{}.ckan_of_worms.'.format(fedmsg_config['topic_prefix'], fedmsg_config['environment'])
-        for name, endpoint, topic, message in fedmsg.tail_messages(**fedmsg_config):
-            if not topic.startswith(expected_topic_prefix):
-                log.debug(u'Ignoring message: {}, {}'.format(topic, name))
-                continue
-            kind, action = topic[len(expected_topic_prefix):].split('.')
-            if kind == 'dataset':
-                if action in ('create', 'update'):
-                    while len(pool) >= args.thread_count:
-                        time.sleep(0.1)
-                    pool.add(thread.start_new_thread(check_dataset_urls_in_thread, (message['msg'],)))
-                else:
-                    log.debug(u'TODO: Handle {}, {} for {}'.format(kind, action, message))
+            modname = conv.pipe(
+                conv.empty_to_none,
+                conv.test(lambda value: value == value.strip('.'), error = 'Value must not begin or end with a "."'),
+                conv.default('ckan_of_worms'),
+                ),
+#            name = conv.pipe(
+#                conv.empty_to_none,
+#                conv.default('ckan_of_worms.{}'.format(hostname)),
+#                ),
+            topic_prefix = conv.pipe(
+                conv.empty_to_none,
+                conv.test(lambda value: value == value.strip('.'), error = 'Value must not begin or end with a "."'),
+                ),
+            ),
+        default = 'drop',
+        ))(dict(config_parser.items('fedmsg')))
+
+    # Read in the config from /etc/fedmsg.d/.
+    fedmsg_config = fedmsg.config.load_config([], None)
+    # Disable a warning about not sending.  We know.  We only want to tail.
+    fedmsg_config['mute'] = True
+    # Disable timing out so that we can tail forever.  This is deprecated
+    # and will disappear in future versions.
+    fedmsg_config['timeout'] = 0
+    # For the time being, don't require message to be signed.
+    fedmsg_config['validate_signatures'] = False
+    for key, value in fedmsg_conf.iteritems():
+        if value is not None:
+            fedmsg_config[key] = value
+
+    expected_topic_prefix = '{}.{}.ckan_of_worms.'.format(fedmsg_config['topic_prefix'], fedmsg_config['environment'])
+    for name, endpoint, topic, message in fedmsg.tail_messages(**fedmsg_config):
+        if not topic.startswith(expected_topic_prefix):
+            log.debug(u'Ignoring message: {}, {}'.format(topic, name))
+            continue
+        kind, action = topic[len(expected_topic_prefix):].split('.')
+        if kind == 'dataset':
+            if action in ('create', 'update'):
+                enqueue_task(check_dataset_urls, message['msg'])
             else:
                 log.debug(u'TODO: Handle {}, {} for {}'.format(kind, action, message))
+        else:
+            log.debug(u'TODO: Handle {}, {} for {}'.format(kind, action, message))
+
+
+def pop_errors(errors, error):
+    # Remove the given error from a tree of errors and return the tree of the removed errors.
+    popped_errors = {}
+    for key, value in errors.items():
+        if isinstance(value, dict):
+            popped_value = pop_errors(value, error)
+            if not value:
+                del errors[key]
+        elif value == error:
+            popped_value = errors.pop(key)
+        else:
+            continue
+        if popped_value:
+            popped_errors[key] = popped_value
+    return popped_errors
+
+
+def probe_ftp_url(url, deadline):
+    # Check that the file (or directory) exists, using only control commands of pooled FTP connections.
+    split_url = urlparse.urlsplit(url)
+    user = urllib.unquote(split_url.username.encode('utf-8')) if split_url.username else 'anonymous'
+    password = urllib.unquote(split_url.password.encode('utf-8')) if split_url.password else 'anonymous@'
+    # Connections are logged in: Pool them by credentials too (a wrong password must not reuse a valid session).
+    server = (split_url.scheme, split_url.hostname.encode('idna'), split_url.port or 21, user,
+        hashlib.sha1(password).hexdigest())
+    # Like urllib2, consider the path as relative to the login directory.
+    path = urllib.unquote(split_url.path.encode('utf-8')).lstrip('/')
+    while True:
+        start_time = time.time()
+        connection, reused = get_connection(server, lambda: open_ftp_connection(server, password, deadline))
+        connection.sock.deadline = deadline
+        try:
+            content_length = query_ftp_path(connection, path)
+        except (EOFError, ftplib.error_temp, socket.error) as exception:
+            connection.close()
+            if reused and not isinstance(exception, socket.timeout):
+                # The FTP server has closed the idle connection: Retry with a new one.
+                continue
+            raise
+        except ftplib.error_perm as exception:
+            release_connection(server, connection)
+            # Same error as urllib2.
+            raise urllib2.URLError('ftp error: {}'.format(exception))
+        except:
+            connection.close()
+            raise
+        ttfb = time.time() - start_time
+        release_connection(server, connection)
+        return dict(
+            content_length = content_length,
+            reason = None,
+            status = None,
+            ttfb = ttfb,
+            url = url,
+            )
+
+
+def probe_url(url, deadline, previous_url_check = None):
+    if urlparse.urlsplit(url).scheme not in (u'http', u'https'):
+        return probe_ftp_url(url, deadline)
+
+    request_headers = headers.copy()
+    if previous_url_check is not None \
+            and (previous_url_check.get('error') is None or previous_url_check.get('breaker')):
+        # Revalidate a resource that was available (validators of a check skipped by the circuit breaker come from
+        # an available resource): When it is unchanged, the server answers a bodyless 304.
+        if previous_url_check.get('etag') is not None:
+            request_headers['If-None-Match'] = previous_url_check['etag'].encode('utf-8')
+        if previous_url_check.get('last_modified') is not None:
+            request_headers['If-Modified-Since'] = previous_url_check['last_modified'].encode('utf-8')
+    # Try a HEAD request first, to avoid downloading the resource.
+    probe = request_url('HEAD', url, request_headers, deadline)
+    if probe['status'] is not None and probe['status'] >= 400:
+        # Some web servers don't support HEAD or wrongly answer it with an error: Retry with a partial GET.
+        request_headers['Range'] = 'bytes=0-{}'.format(args.read_size - 1)
+        probe = request_url('GET', url, request_headers, deadline)
+    return probe
+
+
+def purge_cached_url_checks(now):
+    # Must be called with cache_by_url_lock held.
+    global cache_by_url_purged
+    cache_by_url_purged = now
+    expired_urls = [
+        url
+        for url, url_check in cache_by_url.iteritems()
+        if url_check['expires'] <= now
+        ]
+    for url in expired_urls:
+        del cache_by_url[url]
+    cache_by_url_statistics['expirations'] += len(expired_urls)
+    log.info(u'URL checks cache: {} entries, {}'.format(len(cache_by_url), u', '.join(
+        u'{} {}'.format(value, name)
+        for name, value in sorted(cache_by_url_statistics.iteritems())
+        )))
+
+
+def put_cached_url_check(url, url_check):
+    with cache_by_url_lock:
+        cache_by_url.pop(url, None)
+        cache_by_url[url] = url_check
+        while len(cache_by_url) > cache_by_url_max_size:
+            cache_by_url.popitem(last = False)
+            cache_by_url_statistics['evictions'] += 1
+
+
+def query_ftp_path(connection, path):
+    # Return the size of the file when it is known.
+    if not path:
+        return None
+    for command in ('SIZE', 'MDTM'):
+        try:
+            response = connection.sendcmd('{} {}'.format(command, path))
+        except ftplib.error_perm as exception:
+            if str(exception)[:3] in ('500', '501', '502', '504'):
+                # Command not supported by server.
+                continue
+            # Path may be a directory.
+            try:
+                connection.cwd(path)
+            except ftplib.error_perm:
+                raise exception
+            connection.cwd(connection.home_directory)
+            return None
+        else:
+            if command == 'SIZE':
+                try:
+                    return int(response[3:].strip())
+                except ValueError:
+                    # Nonstandard reply: The file exists, but its size is unknown.
+                    return None
+            return None
+    if not connection.nlst(path):
+        raise ftplib.error_perm('550 {}: No such file or directory'.format(path))
+    return None
+
+
+def read_url_check_row(url):
+    with cache_lock:
+        return cache_db.execute(
+            'SELECT {} FROM url_checks WHERE url = ?'.format(', '.join(name for name, type in url_check_columns)),
+            (url,),
+            ).fetchone()
+
+
+def recheck_scheduled_url(url):
+    period = args.daemon_period * 3600
+    previous_url_check = load_url_check(url)
+    due_time = None
+    try:
+        if is_url_in_shard(url):
+            url_check = refresh_url_check(url, conv.default_state, previous_url_check)
+            due_time = min(url_check['expires'], url_check['checked'] + period)
+            unchanged = previous_url_check is not None and previous_url_check.get('error') == url_check.get('error')
+        else:
+            # Another shard checks this URL: Only watch its result in the shared cache, until it expires. The alerts
+            # of its datasets are updated only when they differ from the alerts already posted.
+            url_check = previous_url_check
+            due_time = max(url_check['expires'] if url_check is not None else 0, time.time() + args.min_ttl)
+            unchanged = url_check is None
+    finally:
+        with schedule_lock:
+            heapq.heappush(urls_schedule, (due_time if due_time is not None else time.time() + period, url))
+    if unchanged:
+        return
+    for dataset_id in datasets_id_by_url.get(url) or []:
+        dataset = dataset_by_id.get(dataset_id)
+        if dataset is not None:
+            check_dataset_urls(dataset, url_validator = validate_known_url)
+
+
+def record_host_result(host, url_check):
+    error = url_check.get('error')
+    status = url_check.get('status')
+    if not url_check.pop('unreachable', False) and (status is None or status < 500):
+        # The host answered (even if the URL itself is wrong).
+        with breakers_lock:
+            if breaker_by_host.pop(host, None) is not None:
+                log.info(u'Host {} is back.'.format(host))
+        return
+    with breakers_lock:
+        breaker = breaker_by_host.get(host)
+        if breaker is None:
+            breaker = breaker_by_host[host] = dict(
+                backoff = 0,
+                failure_count = 0,
+                open_until = 0,
+                probing = False,
+                )
+        breaker['error'] = error
+        breaker['failure_count'] += 1
+        if breaker['probing'] or breaker['failure_count'] == args.breaker_threshold:
+            breaker['backoff'] = min(2 * breaker['backoff'], args.breaker_max_backoff) if breaker['probing'] \
+                else args.breaker_backoff
+            breaker['open_until'] = time.time() + breaker['backoff']
+            breaker['probing'] = False
+            log.warning(u'Host {} is failing, it will not be requested during {} seconds: {}'.format(host,
+                breaker['backoff'], error))
+
+
+def record_url_metrics(host, url_check):
+    with metrics_lock:
+        metrics = metrics_by_host.get(host)
+        if metrics is None:
+            metrics = metrics_by_host[host] = dict(
+                (name, dict(buckets = [0] * (len(bounds) + 1), count = 0, sum = 0))
+                for name, bounds in metrics_bounds.iteritems()
+                )
+            metrics['statuses'] = {}
+        # Count FTP checks & connection errors, which have no HTTP status, apart.
+        status = unicode(url_check.get('status') or (u'ok' if url_check.get('error') is None else u'error'))
+        metrics['statuses'][status] = metrics['statuses'].get(status, 0) + 1
+        for name, bounds in metrics_bounds.iteritems():
+            value = url_check.get(name)
+            if value is None:
+                continue
+            histogram = metrics[name]
+            histogram['buckets'][bisect.bisect_left(bounds, value)] += 1
+            histogram['count'] += 1
+            histogram['sum'] += value
+
+
+def refresh_url_check(url, state, previous_url_check):
+    # Only the first worker needing this URL checks it. The others wait for its result.
+    with url_checks_in_flight_lock:
+        url_check_in_flight = url_checks_in_flight.get(url)
+        if url_check_in_flight is None:
+            url_check_in_flight = url_checks_in_flight[url] = dict(event = threading.Event())
+            leader = True
+        else:
+            leader = False
+    if not leader:
+        log.debug(u'Waiting for concurrent check of URL: {}'.format(url))
+        url_check_in_flight['event'].wait()
+        url_check = url_check_in_flight.get('url_check')
+        if url_check is None:
+            # The check failed with an exception: Try again.
+            return refresh_url_check(url, state, previous_url_check)
+        return url_check
+    try:
+        host = urlparse.urlsplit(url).hostname
+        breaker = get_open_breaker(host)
+        if breaker is not None:
+            log.debug(u'Host of URL is failing, skipping check: {}'.format(url))
+            now = time.time()
+            url_check = dict(
+                breaker = 1,
+                changed = now,
+                checked = now,
+                error = breaker['error'],
+                expires = max(breaker['open_until'], now),
+                )
+            if previous_url_check is not None:
+                # The URL has not really been checked: Keep its history and, when it was available, its validators
+                # for its next real check.
+                if previous_url_check.get('changed') is not None:
+                    url_check['changed'] = previous_url_check['changed']
+                if previous_url_check.get('error') is None or previous_url_check.get('breaker'):
+                    url_check['etag'] = previous_url_check.get('etag')
+                    url_check['last_modified'] = previous_url_check.get('last_modified')
+        else:
+            acquire_host_slot(host)
+            try:
+                log.debug(u'Checking URL: {}'.format(url))
+                url_check = check_url(url, state, previous_url_check = previous_url_check)
+            finally:
+                release_host_slot(host)
+            record_host_result(host, url_check)
+            record_url_metrics(host, url_check)
+            schedule_url_check(url_check, previous_url_check)
+        redirect_urls = url_check.pop('redirect_urls', None)
+        store_url_check(url, url_check)
+        # Every URL of the redirection chain leads to the same result.
+        for redirect_url in set(canonicalize_url(redirect_url) for redirect_url in redirect_urls or []):
+            if redirect_url != url:
+                store_url_check(redirect_url, url_check.copy())
+        url_check_in_flight['url_check'] = url_check
+    finally:
+        with url_checks_in_flight_lock:
+            del url_checks_in_flight[url]
+        url_check_in_flight['event'].set()
+    return url_check
+
+
+def release_connection(server, connection):
+    with connections_lock:
+        idle_connections = connections_by_server.setdefault(server, [])
+        if len(idle_connections) < args.pool_size:
+            idle_connections.append((connection, time.time()))
+            return
+    connection.close()
+
+
+def release_host_slot(host):
+    with hosts_condition:
+        slot_by_host[host]['active_count'] -= 1
+        hosts_condition.notify_all()
+
+
+def request_url(method, url, request_headers, deadline):
+    # Send a request, following redirects, through pooled keep-alive connections.
+    redirect_urls = []
+    start_time = time.time()
+    while True:
+        split_url = urlparse.urlsplit(url)
+        # Redirect targets are checked like urllib2 did.
+        if split_url.scheme not in (u'ftp', u'ftps', u'http', u'https'):
+            raise urllib2.URLError('unknown url type: {}'.format(split_url.scheme.encode('utf-8')))
+        if not split_url.hostname:
+            raise urllib2.URLError('no host given')
+        if split_url.scheme in (u'ftp', u'ftps'):
+            probe = probe_ftp_url(url, deadline)
+            probe['redirect_urls'] = redirect_urls
+            return probe
+        host = split_url.hostname.encode('idna')
+        server = (split_url.scheme, host, split_url.port or (443 if split_url.scheme == u'https' else 80))
+        path = urlparse.urlunsplit((u'', u'', split_url.path or u'/', split_url.query, u'')).encode('utf-8')
+        while True:
+            connection, reused = get_connection(server, lambda: open_http_connection(server, deadline))
+            connection.sock.deadline = deadline
+            try:
+                connection.request(method, path, headers = request_headers)
+                response = connection.getresponse()
+            except socket.timeout:
+                connection.close()
+                raise
+            except (httplib.HTTPException, socket.error):
+                connection.close()
+                if reused:
+                    # The web server has closed the idle connection: Retry with a new one.
+                    continue
+                raise
+            break
+        ttfb = time.time() - start_time
+        # Never keep more than read_size bytes of the body in memory (the server may ignore the Range header).
+        try:
+            response.read(args.read_size)
+        except:
+            connection.close()
+            raise
+        if response.isclosed() and not response.will_close:
+            # The body has been read entirely, so the connection can be reused.
+            release_connection(server, connection)
+        else:
+            connection.close()
+        location = response.getheader('location')
+        if response.status not in redirect_statuses or not location or len(redirect_urls) >= max_redirects:
+            etag = response.getheader('etag')
+            last_modified = response.getheader('last-modified')
+            return dict(
+                content_length = get_content_length(response),
+                etag = etag.decode('latin-1') if etag is not None else None,
+                last_modified = last_modified.decode('latin-1') if last_modified is not None else None,
+                reason = response.reason,
+                redirect_urls = redirect_urls,
+                status = response.status,
+                ttfb = ttfb,
+                url = url,
+                )
+        url = urlparse.urljoin(url, location.decode('utf-8', 'replace'))
+        redirect_urls.append(url)
+
+
+def run_daemon():
+    # Check every known URL when it is due, at a steady rate that checks the whole catalogue in daemon_period hours.
+    period = args.daemon_period * 3600
+    next_start = time.time()
+    reload_time = 0
+    while True:
+        now = time.time()
+        if now >= reload_time:
+            index_datasets()
+            reload_time = now + period
+        with schedule_lock:
+            due_time, url = urls_schedule[0] if urls_schedule else (None, None)
+        if url is None:
+            time.sleep(1)
+            continue
+        # URLs of other shards are only watched, so they don't count in the rate of checks.
+        start_time = max(due_time, next_start) if is_url_in_shard(url) else due_time
+        if start_time > now:
+            time.sleep(min(start_time - now, 1))
+            continue
+        with schedule_lock:
+            heapq.heappop(urls_schedule)
+        if url not in datasets_id_by_url:
+            # URL is no longer used by any dataset.
+            continue
+        if is_url_in_shard(url):
+            next_start = max(next_start, now) + period / max(shard_urls_count, 1)
+        enqueue_task(recheck_scheduled_url, url)
+
+
+def run_worker():
+    global workers_busy_count, workers_busy_time
+    while True:
+        task = tasks_queue.get()
+        try:
+            if task is None:
+                return
+            function, arguments = task
+            with workers_lock:
+                workers_busy_count += 1
+            start_time = time.time()
+            try:
+                function(*arguments)
+            except:
+                log.exception(u'An exception occurred for {0}'.format(arguments))
+            finally:
+                with workers_lock:
+                    workers_busy_count -= 1
+                    workers_busy_time += time.time() - start_time
+        finally:
+            tasks_queue.task_done()
+
+
+def schedule_url_check(url_check, previous_url_check):
+    # The longer an URL has kept the same result, the less often it is checked. Failing URLs are checked often, to
+    # detect their repair quickly.
+    # A check skipped by the circuit breaker of the host didn't observe the URL, so it doesn't end its history.
+    if previous_url_check is not None and previous_url_check.get('changed') is not None \
+            and (previous_url_check.get('error') == url_check.get('error') or previous_url_check.get('breaker')):
+        url_check['changed'] = previous_url_check['changed']
     else:
-        request = urllib2.Request(urlparse.urljoin(conf['ckan_of_worms.site_url'], 'api/1/datasets'), headers = headers)
-        response = urllib2.urlopen(request)
-        datasets_id = conv.check(conv.pipe(
-            cow_response_to_value,
-            conv.not_none,
-            ))(response.read(), state = conv.default_state)
+        url_check['changed'] = url_check['checked']
+    if url_check.get('error') is None:
+        ttl = min(max((url_check['checked'] - url_check['changed']) / 2, args.min_ttl), args.max_ttl)
+    else:
+        ttl = args.min_ttl
+    url_check['expires'] = url_check['checked'] + ttl
 
-        for dataset_id in datasets_id:
-            request = urllib2.Request(urlparse.urljoin(conf['ckan_of_worms.site_url'],
-                'api/1/datasets/{}'.format(dataset_id)), headers = headers)
-            response = urllib2.urlopen(request)
-            dataset = conv.check(conv.pipe(
-                cow_response_to_value,
-                conv.not_none,
-                ))(response.read(), state = conv.default_state)
-            check_dataset_urls(dataset)
 
-    return 0
+def start_workers():
+    global tasks_queue
+    tasks_queue = Queue.Queue(args.queue_size if args.queue_size is not None else 2 * args.thread_count)
+    for index in range(args.thread_count):
+        worker = threading.Thread(name = 'worker-{}'.format(index), target = run_worker)
+        worker.daemon = True
+        worker.start()
+        workers.append(worker)
+    statistics_thread = threading.Thread(name = 'statistics', target = log_workers_statistics)
+    statistics_thread.daemon = True
+    statistics_thread.start()
 
 
-def validate_url(url, state = None):
+def stop_workers():
+    # Let the workers complete the tasks that are still waiting in queue, then stop.
+    log.info(u'Waiting for {} queued tasks to be completed.'.format(tasks_queue.qsize()))
+    for worker in workers:
+        tasks_queue.put(None)
+    for worker in workers:
+        worker.join()
+    del workers[:]
+    if args.metrics_file is not None:
+        write_metrics(args.metrics_file)
+
+
+def store_url_check(url, url_check):
+    put_cached_url_check(url, url_check)
+    if cache_db is not None:
+        call_db(write_url_check_row, url, url_check)
+
+
+def strip_dataset(dataset):
+    # Keep only the attributes of the dataset needed to check its URLs and update its alerts.
+    stripped_dataset = dict(
+        (key, dataset.get(key))
+        for key in ('draft_id', 'id', 'name', 'url')
+        )
+    stripped_dataset['alerts'] = dict(
+        (level, {app_name: level_alerts[app_name]})
+        for level, level_alerts in (dataset.get('alerts') or {}).iteritems()
+        if level_alerts.get(app_name)
+        )
+    stripped_dataset['related'] = [
+        dict(image_url = related_link.get('image_url'), url = related_link.get('url'))
+        for related_link in dataset.get('related') or []
+        ]
+    stripped_dataset['resources'] = [
+        dict(format = resource.get('format'), url = resource.get('url'))
+        for resource in dataset.get('resources') or []
+        ]
+    return stripped_dataset
+
+
+def to_ogc_capabilities_url(url, format = None):
+    # Replace the URL of a request to an OGC web service (WMS, WFS...) with the GetCapabilities URL of the service,
+    # so that all the resources sharing a service are checked with a single lightweight request.
+    split_url = urlparse.urlsplit(url)
+    if split_url.scheme not in (u'http', u'https'):
+        return url
+    query = urlparse.parse_qsl(split_url.query.encode('utf-8'), keep_blank_values = True)
+    service = None
+    for name, value in query:
+        if name.lower() == 'service':
+            # The value may be any sequence of bytes, but only ASCII service names matter.
+            service = value.decode('utf-8', 'replace').upper()
+    if service is None and isinstance(format, basestring) and format.upper() in (u'WFS', u'WMS'):
+        # The format alone is not enough to rewrite the URL of a document (a page describing the service, etc).
+        extension = os.path.splitext(split_url.path.rstrip(u'/').rsplit(u'/', 1)[-1])[1].lower()
+        if extension and extension not in ogc_script_extensions:
+            return url
+        service = format.upper()
+    if service not in ogc_services:
+        return url
+    query = [
+        (name, value)
+        for name, value in query
+        if name.lower() not in ogc_request_parameters
+        ]
+    query.append(('SERVICE', service.encode('utf-8')))
+    query.append(('REQUEST', 'GetCapabilities'))
+    return urlparse.urlunsplit((split_url.scheme, split_url.netloc, split_url.path,
+        urllib.urlencode(query).decode('utf-8'), u''))
+
+
+def validate_known_url(url, state = None, deadline = None):
+    # Use the latest result of URL, even when it has expired, and check it only when it is unknown.
+    url_check = load_url_check(url) if url is not None else None
+    if url_check is None:
+        return validate_url(url, state = state, deadline = deadline)
+    return url, url_check.get('error')
+
+
+def validate_url(url, state = None, deadline = None):
     if url is None:
         return None, None
     if state is None:
         state = conv.default_state
-    now = datetime.datetime.now()
-    refresh = now + datetime.timedelta(minutes = 5)
-    url_cache = cache_by_url.get(url)
-    if url_cache is not None and url_cache['refresh'] > now:
+    url_check = load_url_check(url)
+    if url_check is not None and url_check['expires'] > time.time():
         log.debug(u'Retrieving URL from cache: {}'.format(url))
-        return url, url_cache.get('error')
-    log.debug(u'Checking URL: {}'.format(url))
-    request = urllib2.Request(url.encode('utf-8'), headers = headers)
-    try:
-        response = urllib2.urlopen(request, timeout = 60).read()
-    except socket.timeout as exception:
-        error = state._(u'A timeout error occured when trying to connect to the web server: {0}').format(exception)
-        cache_by_url[url] = dict(error = error, refresh = refresh)
-        return url, error
-    except urllib2.HTTPError as response:
-        if 200 <= response.code < 400:
-            error = state._(u'An error occured when trying to connect to the web server: {0:d} {1}').format(
-                response.code, response.msg)
-            cache_by_url[url] = dict(error = error, refresh = refresh)
-            return url, error
-        if response.code not in []:
-            error = state._(u'The web server responded with a bad status code: {0:d} {1}').format(response.code,
-                response.msg)
-            cache_by_url[url] = dict(error = error, refresh = refresh)
-            return url, error
-    except urllib2.URLError as exception:
-        error = state._(u'An error occured when trying to connect to the web server: {0}').format(exception)
-        cache_by_url[url] = dict(error = error, refresh = refresh)
-        return url, error
-    except:
-        error = state._(u'An error occured when trying to connect to the web server: {0}').format(sys.exc_info()[0])
-        cache_by_url[url] = dict(error = error, refresh = refresh)
-        return url, error
-    cache_by_url[url] = dict(refresh = refresh)
-    return url, None
+        return url, url_check.get('error')
+    if not is_url_in_shard(url):
+        url_check = wait_for_url_check(url, deadline = deadline)
+        if url_check is not None and url_check['expires'] > time.time():
+            return url, url_check.get('error')
+        if deadline is not None and time.time() >= deadline:
+            return url, state._(u'The URL has not been checked in time.')
+        log.warning(u'URL has not been checked by its shard in time, checking it: {}'.format(url))
+    return url, refresh_url_check(url, state, url_check).get('error')
+
+
+def wait_for_url_check(url, deadline = None):
+    # Wait for the check of an URL by another shard, using the cache shared by every shard, but never after the given
+    # deadline.
+    deadline = min(time.time() + args.shard_timeout, deadline) if deadline is not None \
+        else time.time() + args.shard_timeout
+    log.debug(u'Waiting for check of URL by another shard: {}'.format(url))
+    while True:
+        url_check = load_url_check(url)
+        if url_check is not None and url_check['expires'] > time.time() or time.time() >= deadline:
+            return url_check
+        time.sleep(1)
+
+
+def write_metrics(path):
+    with metrics_lock:
+        text = json.dumps(
+            dict(
+                bounds = metrics_bounds,
+                hosts = metrics_by_host,
+                updated = time.time(),
+                ),
+            indent = 2,
+            sort_keys = True,
+            )
+    # Replace the file atomically, so that it can be read at any time.
+    temporary_path = path + '.tmp'
+    with open(temporary_path, 'w') as metrics_file:
+        metrics_file.write(text)
+    os.rename(temporary_path, path)
+
+
+def write_url_check_row(url, url_check):
+    with cache_lock:
+        cache_db.execute(
+            'INSERT OR REPLACE INTO url_checks (url, {}) VALUES (?, {})'.format(
+                ', '.join(name for name, type in url_check_columns),
+                ', '.join('?' for column in url_check_columns),
+                ),
+            [url] + [url_check.get(name) for name, type in url_check_columns],
+            )
+        cache_db.commit()
 
 
 if __name__ == '__main__':
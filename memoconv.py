@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+
+
+# CowBots -- Error detection bots for CKAN-of-Worms
+# By: Emmanuel Raviart <emmanuel@raviart.com>
+#
+# Copyright (C) 2013 Etalab
+# http://github.com/etalab/cowbots
+#
+# This file is part of CowBots.
+#
+# CowBots is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# CowBots is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Memoize pure biryani converters of strings.
+
+The same strings (tag names, formats, territories, etc) recur across the datasets: memoize caches the results of
+their converters.
+"""
+
+
+from biryani1.states import default_state
+
+
+memoized_converters = []  # Converters returned by memoize, to report their statistics
+string_types = (str, unicode)
+
+
+# Converters Factories
+
+
+def memoize(converter, name, max_size = 10000):
+    # Only strings are memoized, because equal strings of the same class always give the same results. When the cache
+    # is full, it is emptied.
+    cache = {}
+    statistics = dict(hits = 0, misses = 0)
+
+    def memoized_converter(value, state = None):
+        if state is None:
+            state = default_state
+        if value.__class__ not in string_types:
+            return converter(value, state = state)
+        key = (state, value.__class__, value)
+        result = cache.get(key)
+        if result is None:
+            statistics['misses'] += 1
+            converted_value, error = converter(value, state = state)
+            # Results containing lists or dicts are copied, because the callers may modify them.
+            result = (converted_value, error, is_mutable(converted_value) or is_mutable(error))
+            if len(cache) >= max_size:
+                cache.clear()
+            cache[key] = result
+        else:
+            statistics['hits'] += 1
+        converted_value, error, mutable = result
+        if mutable:
+            return copy_mutable(converted_value), copy_mutable(error)
+        return converted_value, error
+
+    memoized_converter.cache = cache
+    memoized_converter.name = name
+    memoized_converter.statistics = statistics
+    memoized_converters.append(memoized_converter)
+    return memoized_converter
+
+
+# Functions
+
+
+def copy_mutable(value):
+    if isinstance(value, list):
+        return [copy_mutable(item) for item in value]
+    if isinstance(value, dict):
+        return dict((key, copy_mutable(item)) for key, item in value.iteritems())
+    return value
+
+
+def is_mutable(value):
+    return isinstance(value, (dict, list))